@@ -0,0 +1,160 @@
+import os
+import gzip
+import json
+import logging
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from lxml import etree
+from metapub import PubMedArticle
+
+from paper_downloader.papers import make_paper, ndjson_to_json
+
+logger = logging.getLogger("paper-downloader")
+
+# The filters of the current worker process, see _init_worker.
+_filters = {}
+
+
+def _init_worker(pmids, keywords, author, tmp_dir):
+    _filters["pmids"] = pmids
+    _filters["keywords"] = [keyword.lower() for keyword in keywords or []]
+    _filters["author"] = author
+    _filters["tmp_dir"] = tmp_dir
+
+
+def _match(pmid, element):
+    pmids = _filters.get("pmids")
+    if pmids is not None and pmid not in pmids:
+        return False
+
+    keywords = _filters.get("keywords")
+    if keywords:
+        text = " ".join(
+            "".join(node.itertext())
+            for path in ["ArticleTitle", "Abstract"]
+            for node in element.iterfind("MedlineCitation/Article/" + path)
+        ).lower()
+        return any(keyword in text for keyword in keywords)
+
+    return True
+
+
+def _clear(element):
+    # Free the parsed elements, so the memory doesn't grow with the file.
+    element.clear()
+    while element.getprevious() is not None:
+        del element.getparent()[0]
+
+
+def _write_paper(output, pmid, element):
+    try:
+        xml = b"<PubmedArticleSet>" + etree.tostring(element) + b"</PubmedArticleSet>"
+        paper = make_paper(pmid, PubMedArticle(xml), _filters["author"])
+        output.write(json.dumps(paper) + "\n")
+        return True
+    except Exception as e:
+        logger.error("Parse %s error, reason: %s" % (pmid, e))
+        return False
+
+
+def ingest_file(filename):
+    """Stream-parse one baseline/update file and save the matched articles.
+
+    Returns:
+        tuple: (filename, the NDJSON file of the matched articles, the matched
+            pmids, the pmids deleted by the file)
+    """
+    fd, output_file = tempfile.mkstemp(suffix=".ndjson", dir=_filters["tmp_dir"])
+    matched = []
+    deleted = []
+    opener = gzip.open if filename.endswith(".gz") else open
+    with opener(filename, "rb") as f, os.fdopen(fd, "w") as output:
+        try:
+            for _, element in etree.iterparse(
+                f, events=("end",), tag=("PubmedArticle", "DeleteCitation")
+            ):
+                if element.tag == "DeleteCitation":
+                    deleted.extend(pmid.text.strip() for pmid in element.iter("PMID"))
+                else:
+                    pmid = element.findtext("MedlineCitation/PMID", "").strip()
+                    if pmid and _match(pmid, element):
+                        if _write_paper(output, pmid, element):
+                            matched.append(pmid)
+                _clear(element)
+        except etree.XMLSyntaxError as e:
+            # The lxml errors cannot be sent back from the worker process.
+            raise Exception("Parse %s error, reason: %s" % (filename, e))
+
+    return filename, output_file, matched, deleted
+
+
+def ingest_baseline(
+    files,
+    output_file,
+    pmids=None,
+    keywords=None,
+    author="Anonymous",
+    workers=1,
+    get_impact_factor_fn=None,
+):
+    """Ingest the articles from the local PubMed baseline/update files.
+
+    The files are parsed one per worker process. They must be sorted like the
+    PubMed releases (baseline first, then the updates), a later version of an
+    article replaces the earlier one and a DeleteCitation removes it.
+
+    Returns:
+        int: the number of ingested articles.
+    """
+    files = sorted(files)
+    pmids = set(str(pmid) for pmid in pmids) if pmids is not None else None
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(output_file)))
+    results = []
+    try:
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(pmids, keywords, author, tmp_dir),
+        ) as executor:
+            for result in executor.map(ingest_file, files):
+                logger.info("Find %s articles in %s" % (len(result[2]), result[0]))
+                results.append(result)
+
+        # Find the file which has the last version of each article.
+        latest = {}
+        for index, (_, _, matched, deleted) in enumerate(results):
+            for pmid in deleted:
+                latest.pop(pmid, None)
+            for pmid in matched:
+                latest[pmid] = index
+
+        count = 0
+        stream_file = os.path.join(tmp_dir, "ingested.ndjson")
+        with open(stream_file, "w") as stream:
+            for index, (_, result_file, _, _) in enumerate(results):
+                with open(result_file, "r") as f:
+                    for line in f:
+                        paper = json.loads(line)
+                        pmid = str(paper["pmid"])
+                        if latest.get(pmid) != index:
+                            continue
+                        del latest[pmid]
+                        if get_impact_factor_fn:
+                            (
+                                paper["impact_factor"],
+                                paper["journal"],
+                            ) = get_impact_factor_fn(paper["journal_abbr"])
+                        stream.write(json.dumps(paper) + "\n")
+                        count += 1
+                os.remove(result_file)
+
+        if output_file.endswith(".ndjson"):
+            os.replace(stream_file, output_file)
+        else:
+            ndjson_to_json(stream_file, output_file)
+        return count
+    finally:
+        for filename in os.listdir(tmp_dir):
+            os.remove(os.path.join(tmp_dir, filename))
+        os.rmdir(tmp_dir)
@@ -0,0 +1,181 @@
+import os
+import time
+import json
+import sqlite3
+import hashlib
+import logging
+import tempfile
+import threading
+
+logger = logging.getLogger("paper-downloader")
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "paper-downloader",
+)
+# 1 GB
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+# Seconds to keep the responses of each endpoint. Search results change every
+# day, the records and the article pages rarely do.
+DEFAULT_TTLS = {
+    "esearch": 60 * 60,
+    "efetch": 7 * 24 * 60 * 60,
+    "pmc": 7 * 24 * 60 * 60,
+    "idconv": 24 * 60 * 60,
+}
+# These parameters don't change the response.
+IGNORED_PARAMS = ["api_key", "tool", "email"]
+
+
+class ResponseCache(object):
+    """A size-bounded cache of http responses on the local disk.
+
+    Every response is saved as a file named by the hash of its normalized
+    request (method, url and sorted parameters), and is expired by the ttl of
+    its endpoint. An sqlite table keeps the size and the last access time of
+    every file, the least recently used files are evicted when the cache is
+    larger than max_size. It can be shared by several processes.
+
+    Steps:
+        cache = ResponseCache("~/.cache/paper-downloader")
+        content = cache.get("efetch", url, params)
+        cache.set("efetch", url, params, content)
+    """
+
+    def __init__(self, cache_dir=None, max_size=DEFAULT_MAX_SIZE, ttls=None):
+        self.cache_dir = os.path.abspath(
+            os.path.expanduser(cache_dir or DEFAULT_CACHE_DIR)
+        )
+        self.objects_dir = os.path.join(self.cache_dir, "objects")
+        self.max_size = max_size
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.lock = threading.Lock()
+
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self.conn = sqlite3.connect(
+            os.path.join(self.cache_dir, "responses.sqlite"),
+            timeout=30,
+            check_same_thread=False,
+        )
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                endpoint TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                expires_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS responses_accessed_at
+                ON responses (accessed_at);
+            """
+        )
+        self.size = self._total_size()
+
+    def _total_size(self):
+        return self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+
+    @staticmethod
+    def make_key(url, params=None, method="GET"):
+        params = {
+            k: str(v)
+            for k, v in (params or {}).items()
+            if k not in IGNORED_PARAMS and v is not None
+        }
+        request = json.dumps([method.upper(), url, sorted(params.items())])
+        return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.objects_dir, key[:2], key)
+
+    def get(self, endpoint, url, params=None, method="GET"):
+        """Get the cached response content, None if it is missing or expired."""
+        key = self.make_key(url, params, method)
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT expires_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+
+            if row[0] < now:
+                self._delete(key)
+                return None
+
+            try:
+                with open(self._path(key), "rb") as f:
+                    content = f.read()
+            except OSError:
+                self._delete(key)
+                return None
+
+            with self.conn:
+                self.conn.execute(
+                    "UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key)
+                )
+            return content
+
+    def set(self, endpoint, url, params, content, method="GET"):
+        """Cache a response content for the ttl of the endpoint."""
+        ttl = self.ttls.get(endpoint)
+        if not ttl or len(content) > self.max_size:
+            return
+
+        key = self.make_key(url, params, method)
+        path = self._path(key)
+        now = time.time()
+        with self.lock:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write to a temporary file first, readers never see a partial file.
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+
+            with self.conn:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                    (key, endpoint, len(content), now + ttl, now),
+                )
+            self.size += len(content)
+            if self.size > self.max_size:
+                self._evict()
+
+    def _delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+        with self.conn:
+            self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+
+    def _evict(self):
+        now = time.time()
+        for (key,) in self.conn.execute(
+            "SELECT key FROM responses WHERE expires_at < ?", (now,)
+        ).fetchall():
+            self._delete(key)
+
+        # Other processes may share the cache, so count the size again.
+        total = self._total_size()
+        self.size = total
+        if total <= self.max_size:
+            return
+
+        for key, size in self.conn.execute(
+            "SELECT key, size FROM responses ORDER BY accessed_at"
+        ).fetchall():
+            self._delete(key)
+            total -= size
+            if total <= self.max_size:
+                break
+
+        self.size = total
+        logger.info("Evict the response cache to %s bytes." % total)
+
+    def close(self):
+        self.conn.close()
@@ -1,23 +1,51 @@
 import os
 import re
 import click
-import requests
 import logging
 import time
 import json
-import copy
-import hashlib
+import tempfile
 import csv
 import yaml
 from datetime import datetime
 import subprocess
+from collections import OrderedDict
 from tqdm import tqdm
-from metapub import PubMedFetcher
+from metapub import PubMedFetcher, PubMedArticle
 from lxml import etree
 from bs4 import BeautifulSoup
 import urllib3
 import bibtexparser
-from retrying import retry
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from paper_downloader import client
+from paper_downloader.ratelimit import (
+    DEFAULT_HOST_CONCURRENCY,
+    HOST_CONCURRENCY,
+    get_ncbi_limiter,
+    get_retry_after,
+    set_host_limiter,
+)
+from paper_downloader.index import PmidIndex, PMID_INDEX_FILE
+from paper_downloader.cache import ResponseCache, DEFAULT_CACHE_DIR
+from paper_downloader.papers import (
+    make_paper,
+    ndjson_to_json,
+    read_json,
+    read_ndjson,
+    write_json,
+)
+from paper_downloader.sources import (
+    CaptchaNeedException,
+    SciHub,
+    download_pmc,
+    get_pmc_page,
+    find_pmc_pdf_links,
+    headers,
+)
+from paper_downloader.store import PdfStore
+from paper_downloader.pdfcheck import PdfManifest, PDF_MANIFEST_FILE
+from paper_downloader.failures import FailureLedger, FAILURES_FILE
+from paper_downloader.metrics import reset_metrics
 
 # log config
 # create logger
@@ -36,7 +64,7 @@ def send_notification(msg, access_token=None):
         "text": {"content": msg},
     }
 
-    r = requests.post(url, headers=headers, data=json.dumps(data))
+    r = client.post(url, headers=headers, data=json.dumps(data))
     logger.info(r.text)
 
 
@@ -58,16 +86,12 @@ def set_log(log_path):
 urllib3.disable_warnings()
 
 # constants
-SCHOLARS_BASE_URL = "https://scholar.google.com/scholar"
-HEADERS = {
-    "User-Agent": "Mozilla/5.0 (X11; Linux x86_64; rv:27.0) Gecko/20100101 Firefox/27.0"
-}
-
-headers = {
-    "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.114 Safari/537.36"
-}
-
-
+EUTILS_BASE_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/"
+# EFetch returns at most 10,000 uids per request from the history server.
+HISTORY_PAGE_SIZE = 10000
+# fetch-pdf saves the updated metadata every 100 articles or 60 seconds.
+METADATA_FLUSH_EVERY = 100
+METADATA_FLUSH_INTERVAL = 60
 def read_file_as_text(text_file):
     with open(text_file, "r") as f:
         return f.read()
@@ -110,266 +134,136 @@ def write_csv(data, filename):
         writer.writerows(data)
 
 
-def write_json(data, filename):
-    with open(filename, "w") as f:
-        json.dump(data, f, indent=2)
+def get_pmid_list(query_str):
+    """Get the pmids when a query is just a list of pmids.
 
+    The list looks like "123 OR 456 OR 789" (what bib2pd generates), the
+    pmids may also be separated by commas or tagged with [pmid]/[uid].
 
-def read_json(filename):
-    if os.path.exists(filename):
-        with open(filename, "r") as f:
-            return json.load(f)
-    else:
-        return []
-
-
-class SciHub(object):
+    Returns:
+        list: the pmids, or None if the query is not a pure pmid list.
     """
-    SciHub class can search for papers on Google Scholars
-    and fetch/download papers from sci-hub.io
-    """
-
-    def __init__(self):
-        self.sess = requests.Session()
-        self.sess.headers = HEADERS  # type: ignore
-        self.available_base_url_list = self._get_available_scihub_urls()
-        self.base_url = self.available_base_url_list[0] + "/"
-
-    def _get_available_scihub_urls(self):
-        """
-        Finds available scihub urls via https://sci-hub.now.sh/
-        """
-        return ["https://sci-hub.ee", "https://sci-hub.ru", "https://sci-hub.se"]
-        urls = []
-        res = requests.get("https://sci-hub.now.sh/")
-        s = self._get_soup(res.content)
-        for a in s.find_all("a", href=True):
-            if "sci-hub." in a["href"]:
-                urls.append(a["href"])
-        return urls
-
-    def set_proxy(self, proxy):
-        """
-        set proxy for session
-        :param proxy_dict:
-        :return:
-        """
-        if proxy:
-            self.sess.proxies = {
-                "http": proxy,
-                "https": proxy,
-            }
+    if not query_str:
+        return None
 
-    def _change_base_url(self):
-        if not self.available_base_url_list:
-            raise Exception("Ran out of valid sci-hub urls")
-        del self.available_base_url_list[0]
-        self.base_url = f"{self.available_base_url_list[0]}/"
-        logger.info("I'm changing to {}".format(self.available_base_url_list[0]))
+    pmids = []
+    for item in re.split(r"\s+OR\s+|,", str(query_str).strip()):
+        matched = re.match(r"^(\d+)(\[(pmid|uid)\])?$", item.strip(), re.IGNORECASE)
+        if not matched:
+            return None
+        pmids.append(matched.group(1))
+    return pmids
 
-    def search(self, query, limit=10, download=False):
-        """
-        Performs a query on scholar.google.com, and returns a dictionary
-        of results in the form {'papers': ...}. Unfortunately, as of now,
-        captchas can potentially prevent searches after a certain limit.
-        """
-        start = 0
-        results = {"papers": []}
 
-        while True:
-            try:
-                res = self.sess.get(
-                    SCHOLARS_BASE_URL, params={"q": query, "start": start}
-                )
-            except requests.exceptions.RequestException as e:
-                results["err"] = (
-                    "Failed to complete search with query %s (connection error)" % query
-                )
-                return results
+class ImpactFactor(object):
+    """Resolve the impact factor of journals.
 
-            s = self._get_soup(res.content)
-            papers = s.find_all("div", class_="gs_r")
+    The journal table of impact_factor is loaded once per process and the
+    results are memoized by the normalized journal name in a bounded LRU,
+    which can also be persisted to a json file between runs.
 
-            if not papers:
-                if "CAPTCHA" in str(res.content):
-                    results["err"] = (
-                        "Failed to complete search with query %s (captcha)" % query
-                    )
-                return results
+    Steps:
+        impact_factor = ImpactFactor(cache_file="impact_factor.json")
+        impact_factor("Nat Commun")
+        impact_factor.save()
+    """
 
-            for paper in papers:
-                if not paper.find("table"):
-                    source = None
-                    pdf = paper.find("div", class_="gs_ggs gs_fl")
-                    link = paper.find("h3", class_="gs_rt")
+    # The same fields and order as impact_factor.core.Factor.search
+    SEARCH_KEYS = ["issn", "eissn", "nlm_id", "journal", "journal_abbr"]
 
-                    if pdf:
-                        source = pdf.find("a")["href"]
-                    elif link.find("a"):
-                        source = link.find("a")["href"]
-                    else:
-                        continue
+    def __init__(self, cache_file=None, maxsize=4096):
+        self.cache_file = cache_file
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        self.table = None
 
-                    results["papers"].append({"name": link.text, "url": source})
+        if cache_file and os.path.exists(cache_file):
+            try:
+                for key, value in read_json(cache_file).items():
+                    self.cache[key] = tuple(value)
+            except Exception as e:
+                logger.warning("Load %s error, reason: %s" % (cache_file, e))
+
+    @staticmethod
+    def normalize(journal):
+        return " ".join(str(journal).split()).lower()
+
+    def _load_table(self):
+        from impact_factor.core import Factor
+
+        logger.info("Load the journal table of impact factors...")
+        self.table = {key: {} for key in self.SEARCH_KEYS}
+        for record in Factor().filter():
+            for key in self.SEARCH_KEYS:
+                value = record.get(key)
+                if value:
+                    self.table[key].setdefault(self.normalize(value), []).append(
+                        record
+                    )
 
-                    if len(results["papers"]) >= limit:
-                        return results
+    def search(self, journal):
+        if self.table is None:
+            self._load_table()
 
-            start += 10
+        for key in self.SEARCH_KEYS:
+            results = self.table[key].get(journal)
+            if results:
+                return results
+        return []
 
-    @retry(wait_random_min=100, wait_random_max=1000, stop_max_attempt_number=10)
-    def download(self, identifier, destination="", path=None):
-        """
-        Downloads a paper from sci-hub given an indentifier (DOI, PMID, URL).
-        Currently, this can potentially be blocked by a captcha if a certain
-        limit has been reached.
-        """
-        data = self.fetch(identifier)
+    def __call__(self, journal):
+        key = self.normalize(journal)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
 
-        if not "err" in data:
-            self._save(
-                data["pdf"], os.path.join(destination, path if path else data["name"])
-            )
-            return True
+        results = self.search(key)
+        if len(results) == 1:
+            value = (results[0].get("factor"), results[0].get("journal"))
         else:
-            return False
-
-    def fetch(self, identifier):
-        """
-        Fetches the paper by first retrieving the direct link to the pdf.
-        If the indentifier is a DOI, PMID, or URL pay-wall, then use Sci-Hub
-        to access and download paper. Otherwise, just download paper directly.
-        """
+            value = (-1, "Unknown")
 
-        try:
-            url = self._get_direct_url(identifier)
-            logger.info("Resolved url %s for identifier %s" % (url, identifier))
-
-            # verify=False is dangerous but sci-hub.io
-            # requires intermediate certificates to verify
-            # and requests doesn't know how to download them.
-            # as a hacky fix, you can add them to your store
-            # and verifying would work. will fix this later.
-            res = self.sess.get(url, verify=False)
-
-            if res.headers["Content-Type"] != "application/pdf":
-                self._change_base_url()
-                logger.info(
-                    "Failed to fetch pdf with identifier %s "
-                    "(resolved url %s) due to captcha" % (identifier, url)
-                )
-                raise CaptchaNeedException(
-                    "Failed to fetch pdf with identifier %s "
-                    "(resolved url %s) due to captcha" % (identifier, url)
-                )
-                # return {
-                #     'err': 'Failed to fetch pdf with identifier %s (resolved url %s) due to captcha'
-                #            % (identifier, url)
-                # }
-            else:
-                return {
-                    "pdf": res.content,
-                    "url": url,
-                    "name": self._generate_name(res),
-                }
-
-        except requests.exceptions.ConnectionError:
-            logger.info(
-                "Cannot access {}, changing url".format(self.available_base_url_list[0])
-            )
-            self._change_base_url()
+        self.cache[key] = value
+        if len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+        return value
 
-        except requests.exceptions.RequestException as e:
-            logger.info(
-                "Failed to fetch pdf with identifier %s (resolved url %s) due to request exception."
-                % (identifier, url)
-            )
-            return {
-                "err": "Failed to fetch pdf with identifier %s (resolved url %s) due to request exception."
-                % (identifier, url)
-            }
+    def save(self):
+        if self.cache_file:
+            write_json(dict(self.cache), self.cache_file)
 
-    def _get_direct_url(self, identifier):
-        """
-        Finds the direct source url for a given identifier.
-        """
-        id_type = self._classify(identifier)
 
-        return (
-            identifier
-            if id_type == "url-direct"
-            else self._search_direct_url(identifier)
-        )
+_impact_factor = None
 
-    def _search_direct_url(self, identifier):
-        """
-        Sci-Hub embeds papers in an iframe. This function finds the actual
-        source url which looks something like https://moscow.sci-hub.io/.../....pdf.
-        """
-        res = self.sess.get(self.base_url + identifier, verify=False)
-        logger.info("Getting direct url %s" % self.base_url + identifier)
-        s = self._get_soup(res.content)
-        iframe = s.find("iframe")
-        if iframe:
-            return (
-                iframe.get("src")
-                if not iframe.get("src").startswith("//")
-                else "http:" + iframe.get("src")
-            )
 
-    def _classify(self, identifier):
-        """
-        Classify the type of identifier:
-        url-direct - openly accessible paper
-        url-non-direct - pay-walled paper
-        pmid - PubMed ID
-        doi - digital object identifier
-        """
-        if identifier.startswith("http") or identifier.startswith("https"):
-            if identifier.endswith("pdf"):
-                return "url-direct"
-            else:
-                return "url-non-direct"
-        elif identifier.isdigit():
-            return "pmid"
-        else:
-            return "doi"
+def get_last_run(history, query_str):
+    """Find the last successful run of a query in history.json."""
+    for item in reversed(history):
+        if item.get("query_str") == query_str and item.get("time"):
+            return item
+    return None
 
-    def _save(self, data, path):
-        """
-        Save a file give data and a path.
-        """
-        with open(path, "wb") as f:
-            f.write(data)
 
-    def _get_soup(self, html):
-        """
-        Return html soup.
-        """
-        return BeautifulSoup(html, "html.parser")
+def parse_time(value):
+    """Parse a time saved by str(datetime), e.g. 2023-01-01 08:00:00.123456.
 
-    def _generate_name(self, res):
-        """
-        Generate unique filename for paper. Returns a name by calcuating
-        md5 hash of file contents, then appending the last 20 characters
-        of the url which typically provides a good paper identifier.
-        """
-        name = res.url.split("/")[-1]
-        name = re.sub("#view=(.+)", "", name)
-        pdf_hash = hashlib.md5(res.content).hexdigest()
-        return "%s-%s" % (pdf_hash, name[-20:])
+    datetime.fromisoformat needs python 3.7.
+    """
+    for fmt in ["%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S"]:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError("Cannot parse the time %s." % value)
 
 
 def get_impact_factor(journal):
-    from impact_factor.core import Factor
+    global _impact_factor
 
-    fa = Factor()
+    if _impact_factor is None:
+        _impact_factor = ImpactFactor()
 
-    results = fa.search(journal)
-    if len(results) == 1:
-        return (results[0].get("factor"), results[0].get("journal"))
-    else:
-        return (-1, "Unknown")
+    return _impact_factor(journal)
 
 
 class PubMed(PubMedFetcher):
@@ -389,9 +283,36 @@ class PubMed(PubMedFetcher):
         delay=1,
         dest_file=".",
         get_impact_factor_fn=None,
+        batch_size=200,
+        workers=1,
+        api_key=None,
+        use_history=False,
+        pmid_index=None,
+        stream_file=None,
+        materialize=True,
+        checkpoint_file=None,
+        resume=False,
+        mindate=None,
+        maxdate=None,
+        cache=None,
     ):
         self.counts = 0
         self.delay = delay
+        self.batch_size = batch_size
+        self.workers = workers
+        self.api_key = api_key
+        self.use_history = use_history
+        self.pmid_index = pmid_index
+        self.stream_file = stream_file
+        self.materialize = materialize
+        self.checkpoint_file = checkpoint_file
+        self.resume = resume
+        self.completed = []
+        # Only search the articles added to PubMed (EDAT) in this date range.
+        self.mindate = mindate
+        self.maxdate = maxdate
+        self.cache = cache
+        self.limiter = get_ncbi_limiter(api_key)
         self.pmids = []
         self.author = "Anonymous"
         self.metadata = []
@@ -399,34 +320,179 @@ class PubMed(PubMedFetcher):
         self.duplicated_papers = []
         self.get_impact_factor_fn = get_impact_factor_fn
 
-        if os.path.exists(dest_file):
+        finishing = resume and checkpoint_file and os.path.exists(checkpoint_file)
+        if os.path.exists(dest_file) and not finishing:
             raise Exception("%s does exist, please delete it and retry." % dest_file)
 
+        if checkpoint_file and os.path.exists(checkpoint_file) and not resume:
+            raise Exception(
+                "%s does exist, please resume the run or delete it and retry."
+                % checkpoint_file
+            )
+
+        if stream_file and os.path.exists(stream_file) and not resume:
+            raise Exception("%s does exist, please delete it and retry." % stream_file)
+
         super().__init__(method, cachedir)
 
+    def _eutils(self, endpoint, params, max_retries=5):
+        """Send a request to E-utilities through the shared NCBI rate limiter.
+
+        A 429 response pauses the limiter (and so every worker) for the
+        Retry-After period before the request is retried.
+        """
+        url = EUTILS_BASE_URL + endpoint + ".fcgi"
+        data = dict(params, tool="paper-downloader")
+        if self.api_key:
+            data["api_key"] = self.api_key
+
+        # The results on the history server expire, don't cache them.
+        cache = self.cache
+        if "usehistory" in params or "WebEnv" in params:
+            cache = None
+
+        if cache is not None:
+            content = cache.get(endpoint, url, data, method="POST")
+            if content is not None:
+                return content
+
+        for attempt in range(max_retries + 1):
+            self.limiter.acquire()
+            r = client.post(url, data=data, headers=headers)
+            if r.status_code == 429 and attempt < max_retries:
+                wait = get_retry_after(r, default=2**attempt)
+                logger.warning(
+                    "Too many requests to %s, retry after %s seconds." % (url, wait)
+                )
+                self.limiter.pause(wait)
+                continue
+
+            r.raise_for_status()
+            if cache is not None:
+                cache.set(endpoint, url, data, r.content, method="POST")
+            return r.content
+
+    def _map(self, fn, items):
+        """Apply fn to every item and yield the results in order.
+
+        The items are handled by a thread pool when workers > 1, otherwise
+        one by one with the fixed delay between them.
+        """
+        if self.workers > 1:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                yield from executor.map(fn, items)
+        else:
+            for item in items:
+                time.sleep(self.delay)
+                yield fn(item)
+
+    def _date_params(self):
+        if not self.mindate:
+            return {}
+
+        return {
+            "datetype": "edat",
+            "mindate": self.mindate,
+            "maxdate": self.maxdate or datetime.now().strftime("%Y/%m/%d"),
+        }
+
     def _count(self, query_str):
-        result = self.qs.esearch(
+        result = self._eutils(
+            "esearch",
             {
                 "db": "pubmed",
                 "term": query_str,
                 "rettype": "count",
                 "retmax": 250,
                 "retstart": 0,
-            }
+                **self._date_params(),
+            },
         )
         return int(etree.fromstring(result).find("Count").text.strip())
 
+    def _query_pmids(self, query_str, retstart, retmax=250):
+        result = self._eutils(
+            "esearch",
+            {
+                "db": "pubmed",
+                "term": query_str,
+                "retmax": retmax,
+                "retstart": retstart,
+                **self._date_params(),
+            },
+        )
+        return [
+            item.text.strip() for item in etree.fromstring(result).findall("IdList/Id")
+        ]
+
+    def _search_history(self, query_str):
+        """Run the query once and keep the result on the ESearch history server.
+
+        Returns:
+            tuple: (count, webenv, query_key)
+        """
+        result = self._eutils(
+            "esearch",
+            {
+                "db": "pubmed",
+                "term": query_str,
+                "usehistory": "y",
+                "retmax": 0,
+                **self._date_params(),
+            },
+        )
+        root = etree.fromstring(result)
+        return (
+            int(root.find("Count").text.strip()),
+            root.find("WebEnv").text.strip(),
+            root.find("QueryKey").text.strip(),
+        )
+
+    def _history_pmids(self, webenv, query_key, retstart, retmax=HISTORY_PAGE_SIZE):
+        result = self._eutils(
+            "efetch",
+            {
+                "db": "pubmed",
+                "WebEnv": webenv,
+                "query_key": query_key,
+                "rettype": "uilist",
+                "retmode": "text",
+                "retstart": retstart,
+                "retmax": retmax,
+            },
+        )
+        return result.decode("utf-8").split()
+
     def batch_query_pmids(self, query_str, author="Anonymous", token=None):
         logger.info("Fetch the metadata with query_str (%s)..." % query_str)
         pmids = []
-        self.counts = self._count(query_str)
-        for i in range(0, (self.counts // 250) + 1):
-            time.sleep(self.delay)
-            r = self.pmids_for_query(query_str, retmax=250, retstart=i * 250)
+        if self.use_history:
+            # The query is evaluated only once, all pages come from the same
+            # result set on the history server.
+            self.counts, webenv, query_key = self._search_history(query_str)
+            page_size = HISTORY_PAGE_SIZE
+            pages = self._map(
+                lambda retstart: self._history_pmids(
+                    webenv, query_key, retstart=retstart, retmax=page_size
+                ),
+                range(0, self.counts, page_size),
+            )
+        else:
+            self.counts = self._count(query_str)
+            page_size = 250
+            pages = self._map(
+                lambda retstart: self._query_pmids(
+                    query_str, retmax=page_size, retstart=retstart
+                ),
+                range(0, self.counts, page_size),
+            )
+
+        for i, r in enumerate(pages):
             logger.info("Fetch the first %s articles" % len(r))
             if token:
                 send_notification(
-                    f"Fetch the {(i + 1) * 250}/{self.counts} articles", token
+                    f"Fetch the {min((i + 1) * page_size, self.counts)}/{self.counts} articles",
+                    token,
                 )
             pmids.extend(r)
         self.pmids = pmids
@@ -435,6 +501,9 @@ class PubMed(PubMedFetcher):
 
     def remove_dup_pmids(self, files):
         logger.info("Remove the duplicated articles by %s..." % files)
+        if self.pmid_index is not None:
+            return self._remove_dup_pmids_by_index(files)
+
         for file in files:
             try:
                 articles = read_json(file)
@@ -463,65 +532,213 @@ class PubMed(PubMedFetcher):
             except Exception as e:
                 logger.error("Load %s error, reason: %s" % (file, e))
 
-    def fetch_save_metadata(self):
-        logger.info("Fetch the metadata for articles...")
-        pbar = tqdm(self.pmids)
+    def _remove_dup_pmids_by_index(self, files):
+        self.pmid_index.update(files)
+        found = self.pmid_index.lookup(self.pmids)
+        total = len(self.pmids)
+
+        # Only the files which contain duplicated pmids need to be loaded.
+        dup_files = {}
+        for pmid, file in found.items():
+            dup_files.setdefault(file, set()).add(pmid)
 
-        for pmid in pbar:
+        for file, pmids in dup_files.items():
             try:
-                paper = {}
-                article = self.article_by_pmid(pmid)
-                paper["tag"] = self.author
-                paper["pmid"] = int(pmid)
-                paper["pmcid"] = article.pmc if article.pmc else ""
-                paper["pmc_link"] = (
-                    "https://www.ncbi.nlm.nih.gov/pmc/articles/" + article.pmc
-                    if article.pmc
-                    else ""
-                )
-                paper["pubmed_link"] = "https://pubmed.ncbi.nlm.nih.gov/" + pmid
-                paper["abstract"] = (
-                    article.abstract.replace("\n", " ")
-                    if article.abstract is not None
-                    else ""
+                duplicated_papers = [
+                    article
+                    for article in read_json(file)
+                    if str(article.get("pmid")) in pmids
+                ]
+                self.duplicated_papers.extend(duplicated_papers)
+                logger.info(
+                    "Find %s duplicated papers in %s" % (len(duplicated_papers), file)
                 )
-                paper["title"] = article.title
-                paper["imported_date"] = datetime.now().strftime("%Y-%m-%d")
-                paper["authors"] = ", ".join(article.authors)
-                paper["journal_abbr"] = article.journal
-                paper["journal"] = "Unknown"
-                paper["pdf"] = ""
-                paper["html"] = ""
-                paper["impact_factor"] = -1
-                paper["publication"] = article.year
-                paper["doi"] = article.doi if article.doi else ""
-                paper["doi_link"] = "https://doi.org/" + paper["doi"]
-
-                if self.get_impact_factor_fn:
-                    (
-                        paper["impact_factor"],
-                        paper["journal"],
-                    ) = self.get_impact_factor_fn(article.journal)
-
-                self.metadata.append(paper)
             except Exception as e:
-                logger.error("Fetch metadata for %s error, reason: %s" % (pmid, e))
+                logger.error("Load %s error, reason: %s" % (file, e))
+
+        self.pmids = [pmid for pmid in self.pmids if pmid not in found]
+        logger.info(
+            "Find %s duplicated pmids and %s unique pmids"
+            % ((total - len(self.pmids)), len(self.pmids))
+        )
+
+    def fetch_articles(self, pmids):
+        """Fetch a batch of articles with one EFetch request.
+
+        The PubmedArticleSet is parsed once and every PubmedArticle in it is
+        wrapped as a metapub PubMedArticle, so the result is the same as
+        calling article_by_pmid for each pmid.
+
+        Returns:
+            dict: pmid (str) -> PubMedArticle
+        """
+        result = self._eutils(
+            "efetch", {"db": "pubmed", "id": ",".join(pmids), "retmode": "xml"}
+        )
+
+        articles = {}
+        root = etree.fromstring(result)
+        for element in root.iterchildren("PubmedArticle", "PubmedBookArticle"):
+            xml = (
+                b"<PubmedArticleSet>"
+                + etree.tostring(element)
+                + b"</PubmedArticleSet>"
+            )
+            article = PubMedArticle(xml)
+            if article.pmid:
+                articles[str(article.pmid)] = article
+        return articles
+
+    def make_paper(self, pmid, article):
+        return make_paper(pmid, article, self.author, self.get_impact_factor_fn)
+
+    def set_pmids(self, pmids, author="Anonymous"):
+        """Use a known list of pmids instead of searching them."""
+        self.pmids = list(dict.fromkeys(str(pmid).strip() for pmid in pmids))
+        self.counts = len(self.pmids)
+        self.author = author
+        logger.info("Get %s papers" % len(self.pmids))
 
-            pbar.set_description("Processing %s" % pmid)
+    def save_checkpoint(self):
+        """Start the checkpoint journal with the pmids of the query.
 
-        # Don't save when cannot find any results.
-        if len(self.metadata) > 0:
-            logger.info("Find %s new articles." % len(self.metadata))
+        The first line of the journal is the pmid list, every following line
+        is a batch of pmids whose metadata have been written to stream_file.
+        """
+        with open(self.checkpoint_file, "w") as f:
+            f.write(
+                json.dumps(
+                    {"pmids": self.pmids, "counts": self.counts, "author": self.author}
+                )
+                + "\n"
+            )
+
+    def load_checkpoint(self):
+        """Restore the pmid list and the completed pmids of an interrupted run."""
+        completed = set()
+        with open(self.checkpoint_file, "r") as f:
+            header = json.loads(f.readline())
+            for line in f:
+                try:
+                    completed.update(json.loads(line).get("completed", []))
+                except ValueError:
+                    # The last line may be truncated by the interruption.
+                    logger.warning("Skip a broken line in %s" % self.checkpoint_file)
+
+        self.pmids = header.get("pmids", [])
+        self.counts = header.get("counts", len(self.pmids))
+        self.author = header.get("author", "Anonymous")
+
+        # Only keep the records which are in the journal, drop the ones that
+        # were written after the last checkpoint.
+        self.completed = []
+        if os.path.exists(self.stream_file):
+            tmp_file = self.stream_file + ".tmp"
+            with open(self.stream_file, "r") as src, open(tmp_file, "w") as dest:
+                for line in src:
+                    try:
+                        paper = json.loads(line)
+                    except ValueError:
+                        continue
+                    pmid = str(paper.get("pmid"))
+                    if pmid in completed and pmid not in self.completed:
+                        dest.write(json.dumps(paper) + "\n")
+                        self.completed.append(pmid)
+            os.replace(tmp_file, self.stream_file)
+
+        logger.info(
+            "Resume from %s, %s of %s articles are completed."
+            % (self.checkpoint_file, len(self.completed), len(self.pmids))
+        )
+
+    def _fetch_batch(self, batch):
+        try:
+            return batch, self.fetch_articles(batch)
+        except Exception as e:
+            # The articles will be fetched one by one.
+            logger.error(
+                "Fetch metadata for %s articles error, reason: %s" % (len(batch), e)
+            )
+            return batch, {}
+
+    def fetch_save_metadata(self):
+        logger.info("Fetch the metadata for articles...")
+        completed = set(self.completed)
+        pmids = [pmid for pmid in self.pmids if str(pmid) not in completed]
+        pbar = tqdm(total=len(self.pmids), initial=len(self.pmids) - len(pmids))
+        stream = None
+        if self.stream_file:
+            stream = open(self.stream_file, "a" if self.resume else "w")
+        fetched_pmids = [int(pmid) for pmid in self.completed]
+
+        batches = [
+            [str(pmid) for pmid in pmids[i : i + self.batch_size]]
+            for i in range(0, len(pmids), self.batch_size)
+        ]
+        for batch, articles in self._map(self._fetch_batch, batches):
+            batch_pmids = []
+            for pmid in batch:
+                try:
+                    article = articles.get(pmid)
+                    if article is None:
+                        # Go through the rate limiter and the cache too.
+                        article = self.fetch_articles([pmid]).get(pmid)
+                    if article is None:
+                        raise Exception("Cannot find the article in PubMed.")
+
+                    paper = self.make_paper(pmid, article)
+                    fetched_pmids.append(paper["pmid"])
+                    batch_pmids.append(pmid)
+                    if stream is None:
+                        self.metadata.append(paper)
+                    else:
+                        # Keep the memory flat, the records only live on disk.
+                        stream.write(json.dumps(paper) + "\n")
+                except Exception as e:
+                    logger.error("Fetch metadata for %s error, reason: %s" % (pmid, e))
+
+                pbar.set_description("Processing %s" % pmid)
+                pbar.update(1)
+
+            if stream is not None:
+                stream.flush()
+                if self.checkpoint_file:
+                    os.fsync(stream.fileno())
+                    with open(self.checkpoint_file, "a") as f:
+                        f.write(json.dumps({"completed": batch_pmids}) + "\n")
+
+        pbar.close()
+
+        if stream is not None:
+            stream.close()
+            if self.materialize:
+                ndjson_to_json(self.stream_file, self.dest_file)
+        else:
             write_json(self.metadata, self.dest_file)
+
+        if len(fetched_pmids) > 0:
+            logger.info("Find %s new articles." % len(fetched_pmids))
         else:
-            write_json([], self.dest_file)
             logger.warning("Cannot find any new articles.")
 
+        if self.pmid_index is not None:
+            if stream is None or self.materialize:
+                self.pmid_index.add(self.dest_file, fetched_pmids)
+            else:
+                self.pmid_index.add(self.stream_file, fetched_pmids)
+
+        if self.checkpoint_file and os.path.exists(self.checkpoint_file):
+            os.remove(self.checkpoint_file)
+
         if self.duplicated_papers:
             logger.info("Find %s duplicated articles." % len(self.duplicated_papers))
             fileprefix, _ = os.path.splitext(self.dest_file)
             filepath = fileprefix + "_duplicated.json"
             write_json(self.duplicated_papers, filepath)
+            if self.pmid_index is not None:
+                self.pmid_index.add(
+                    filepath, [paper.get("pmid") for paper in self.duplicated_papers]
+                )
 
 
 # paper_metadata
@@ -564,35 +781,6 @@ def pdf_to_html(dest_dir, pdf_file):
             return False
 
 
-def download_pmc(pmcid, filepath):
-    url = "https://www.ncbi.nlm.nih.gov/pmc/articles/" + str(pmcid) + "/"
-    html = requests.get(url, headers=headers)
-    if html.status_code == 200:
-        soup = BeautifulSoup(html.text, "html.parser")
-        pdf_links = soup.find_all("a", attrs={"class": "int-view"})
-        logger.info("Find pdf links: %s" % pdf_links)
-        if pdf_links:
-            pdf_links = [pdf_link.get("href") for pdf_link in pdf_links]
-            pdf_link = list(set(pdf_links))[0]
-            pdf_link = "https://www.ncbi.nlm.nih.gov" + pdf_link
-            pdf = requests.get(pdf_link, headers=headers)
-            if pdf.status_code == 200:
-                with open(filepath, "wb") as f:
-                    f.write(pdf.content)
-                    logger.info("Download %s succssfully." % filepath)
-                return True
-            else:
-                logger.warning(
-                    "Download %s failed, status code is %s." % (url, pdf.status_code)
-                )
-                return False
-    else:
-        logger.warning(
-            "Download %s failed, status code is %s." % (url, html.status_code)
-        )
-        return False
-
-
 @click.group()
 def pubmed():
     pass
@@ -627,10 +815,122 @@ def pubmed():
 @click.option(
     "--token", "-t", required=False, default=None, help="The token for dingtalk."
 )
-def fetch_metadata(output_file, config, delay, logpath, token):
+@click.option(
+    "--batch-size",
+    "-b",
+    required=False,
+    type=click.IntRange(1, 10000),
+    default=200,
+    help="How many articles do you want to fetch in one EFetch request?",
+)
+@click.option(
+    "--workers",
+    "-w",
+    required=False,
+    type=click.IntRange(1, 32),
+    default=1,
+    help="How many concurrent requests? If it is larger than 1, the requests are only limited by the NCBI rate (3 req/s, or 10 req/s with an api key) instead of the delay.",
+)
+@click.option(
+    "--api-key",
+    "-k",
+    required=False,
+    envvar="NCBI_API_KEY",
+    default=None,
+    help="The NCBI api key, it can also be set by the NCBI_API_KEY environment variable.",
+)
+@click.option(
+    "--use-history",
+    "-u",
+    required=False,
+    is_flag=True,
+    default=False,
+    help="Whether run the query only once and page the results from the ESearch history server.",
+)
+@click.option(
+    "--if-cache-file",
+    "-f",
+    required=False,
+    default=None,
+    help="A json file which caches the impact factors of journals between runs.",
+)
+@click.option(
+    "--ndjson",
+    "-s",
+    required=False,
+    is_flag=True,
+    default=False,
+    help="Whether stream the metadata into a NDJSON file (the output file with .ndjson suffix) while fetching.",
+)
+@click.option(
+    "--materialize/--no-materialize",
+    required=False,
+    default=True,
+    help="Whether write the json array into the output file at the end when --ndjson is set.",
+)
+@click.option(
+    "--resume",
+    "-r",
+    required=False,
+    is_flag=True,
+    default=False,
+    help="Whether resume an interrupted run from its checkpoint file (the output file with .checkpoint suffix).",
+)
+@click.option(
+    "--incremental",
+    "-i",
+    required=False,
+    is_flag=True,
+    default=False,
+    help="Whether only search the articles added to PubMed since the last run of the same query (recorded in history.json). It can also be set by incremental: true in the config file.",
+)
+@click.option(
+    "--cache-dir",
+    required=False,
+    envvar="PFETCHER_CACHE_DIR",
+    default=None,
+    help="Where is the http response cache, it is ~/.cache/paper-downloader by default and can also be set by the PFETCHER_CACHE_DIR environment variable.",
+)
+@click.option(
+    "--cache-size",
+    required=False,
+    envvar="PFETCHER_CACHE_SIZE",
+    type=click.IntRange(1),
+    default=1024,
+    help="The max size (MB) of the http response cache.",
+)
+@click.option(
+    "--no-cache",
+    required=False,
+    is_flag=True,
+    default=False,
+    help="Whether disable the http response cache.",
+)
+def fetch_metadata(
+    output_file,
+    config,
+    delay,
+    logpath,
+    token,
+    batch_size,
+    workers,
+    api_key,
+    use_history,
+    if_cache_file,
+    ndjson,
+    materialize,
+    resume,
+    incremental,
+    cache_dir,
+    cache_size,
+    no_cache,
+):
     set_log(logpath)
 
-    if os.path.exists(output_file):
+    # An interrupted run may have written the output file before removing the
+    # checkpoint, --resume finishes it.
+    finishing = resume and os.path.exists(output_file + ".checkpoint")
+    if os.path.exists(output_file) and not finishing:
         raise Exception(
             """
 %s exists. if you want to update the metadata, please delete it first or rename it.
@@ -649,46 +949,125 @@ def fetch_metadata(output_file, config, delay, logpath, token):
         else:
             raise Exception("Please check your config file.")
 
-        query_str = str(c.get("query_str"))
+        query_str = str(c.get("query_str") or "")
         author = c.get("author")
 
+        # A list of pmids doesn't need any search.
+        pmids = c.get("pmids")
+        if pmids:
+            pmids = pmids if type(pmids) == list else get_pmid_list(pmids)
+            if not pmids or not all(str(pmid).strip().isdigit() for pmid in pmids):
+                raise Exception("Please check your config file, pmids is invalid.")
+            query_str = query_str or " OR ".join(str(pmid) for pmid in pmids)
+        else:
+            pmids = get_pmid_list(query_str)
+
         if not query_str:
             logger.warning("Please check your config file.")
             raise Exception(
-                "Please check your config file, It don't contain query_str."
+                "Please check your config file, It don't contain query_str or pmids."
             )
 
         formated_query_str = query_str.replace("'", '"')
         output_file = os.path.abspath(output_file)
 
+        started_at = datetime.now()
+        history_file = os.path.join(os.path.dirname(config), "history.json")
+        mindate = None
+        if (incremental or c.get("incremental")) and not pmids:
+            last_run = get_last_run(read_json(history_file) or [], query_str)
+            if last_run:
+                # Start from the day when the last run started, the overlapped
+                # articles are removed as duplicates.
+                last_time = parse_time(last_run.get("started_at", last_run["time"]))
+                mindate = last_time.strftime("%Y/%m/%d")
+                logger.info(
+                    "Only search the articles added since %s (the last run)." % mindate
+                )
+            else:
+                logger.info("Cannot find the last run of the query, search all.")
+
         output_dir = os.path.dirname(output_file)
+        # The records are always streamed into a file, so an interrupted run
+        # can be resumed. Without --ndjson it is only a temporary file.
+        if ndjson:
+            stream_file = os.path.splitext(output_file)[0] + ".ndjson"
+        else:
+            stream_file = output_file + ".part"
+            materialize = True
+        checkpoint_file = output_file + ".checkpoint"
+
+        if resume and not os.path.exists(checkpoint_file):
+            raise Exception("Cannot find the checkpoint file %s." % checkpoint_file)
+
         files = [
             os.path.join(output_dir, i)
             for i in os.listdir(output_dir)
-            if i.endswith(".json")
+            if (i.endswith(".json") or i.endswith(".ndjson"))
+            and os.path.join(output_dir, i) not in [stream_file, output_file]
         ]
-        pubmed = PubMed(
-            dest_file=output_file, delay=delay, get_impact_factor_fn=get_impact_factor
+        # Keep a connection alive for every worker.
+        if workers > client.DEFAULT_POOL_MAXSIZE:
+            client.configure(pool_maxsize=workers)
+
+        impact_factor = ImpactFactor(cache_file=if_cache_file)
+        cache = (
+            None
+            if no_cache
+            else ResponseCache(cache_dir, max_size=cache_size * 1024 * 1024)
         )
-        pubmed.batch_query_pmids(
-            formated_query_str, author if author else "Anonymous", token=token
+        pubmed = PubMed(
+            # metapub caches into the same directory, even with --no-cache.
+            cachedir=os.path.join(
+                os.path.expanduser(cache_dir or DEFAULT_CACHE_DIR), "metapub"
+            ),
+            dest_file=output_file,
+            delay=delay,
+            get_impact_factor_fn=impact_factor,
+            batch_size=batch_size,
+            workers=workers,
+            api_key=api_key,
+            use_history=use_history,
+            pmid_index=PmidIndex(os.path.join(output_dir, PMID_INDEX_FILE)),
+            stream_file=stream_file,
+            materialize=materialize,
+            checkpoint_file=checkpoint_file,
+            resume=resume,
+            mindate=mindate,
+            cache=cache,
         )
+        if resume:
+            pubmed.load_checkpoint()
+        elif pmids:
+            logger.info("Find %s pmids in the config, skip the search." % len(pmids))
+            pubmed.set_pmids(pmids, author if author else "Anonymous")
+        else:
+            pubmed.batch_query_pmids(
+                formated_query_str, author if author else "Anonymous", token=token
+            )
+        if not resume:
+            pubmed.save_checkpoint()
         send_notification(f"Fetch articles succssfully ({pubmed.counts}).", token)
         pubmed.remove_dup_pmids(files)
         pubmed.fetch_save_metadata()
+        impact_factor.save()
+        if not ndjson and os.path.exists(stream_file):
+            os.remove(stream_file)
 
-        if pubmed.counts > 0:
-            dirname = os.path.dirname(config)
-            history_file = os.path.join(dirname, "history.json")
+        # An incremental run is always recorded, so the next one starts from it.
+        if pubmed.counts > 0 or mindate:
             history = read_json(history_file) or []
             history_item = {
                 "time": str(datetime.now()),
+                "started_at": str(started_at),
                 "query_str": query_str,
                 "total_articles": pubmed.counts,
                 "duplicated_articles": pubmed.counts - len(pubmed.pmids),
                 "valid_articles": len(pubmed.pmids),
                 "filename": output_file,
             }
+            if mindate:
+                history_item["mindate"] = mindate
             send_notification(
                 f"Duplicated articles: {pubmed.counts - len(pubmed.pmids)}, valid articles: {len(pubmed.pmids)}",
                 token,
@@ -698,22 +1077,213 @@ def fetch_metadata(output_file, config, delay, logpath, token):
             write_json(history, history_file)
 
 
-def update_metadata(pmid, metadata, metadata_file, pdf_filepath, html_filepath):
-    article_metadata = filter(lambda x: x.get("pmid") == pmid, metadata)
+def download_pdf(
+    article,
+    output_dir,
+    resolver,
+    store=None,
+    manifest=None,
+    ledger=None,
+    retry_failed=False,
+):
+    """Download the pdf of an article into output_dir with a PdfResolver.
+
+    If a pdf store is set, the pdf is linked from the store when another
+    project has downloaded it, and the downloaded pdf is saved into the store.
+    If a manifest is set, an invalid pdf (e.g. a captcha page) is removed and
+    downloaded again. If a failure ledger is set, the papers which failed
+    recently are skipped unless retry_failed is True.
+
+    Returns:
+        str: the pdf file, None if it cannot be downloaded.
+    """
+    pmid = article.get("pmid")
+    doi = article.get("doi")
 
-    for j in article_metadata:
-        if os.path.isfile(pdf_filepath):
-            pdf_url = "https://publications.3steps.cn/publications/pdf/%s.pdf" % pmid
-            j[
-                "pdf"
-            ] = f"<embed src='{pdf_url}' width='100%' height='600px' type='application/pdf'>"
+    pdf_filepath = os.path.join(output_dir, str(pmid) + ".pdf")
+    if os.path.exists(pdf_filepath):
+        valid, reason = manifest.check(pdf_filepath) if manifest else (True, None)
+        if valid:
+            logger.info("%s.pdf exists in %s, skip it." % (pmid, output_dir))
+            if store and not store.lookup(pmid, doi):
+                store.add(pdf_filepath, pmid=pmid, doi=doi)
+            return pdf_filepath
 
-        # if os.path.isfile(html_filepath):
-        #     j["html"] = 's3://publications/html/%s.html' % pmid
-        j["html"] = "s3://publications/html/%s.html" % pmid
+        logger.warning(
+            "%s is not a valid pdf (%s), download it again." % (pdf_filepath, reason)
+        )
+        os.remove(pdf_filepath)
 
-    with open(metadata_file, "w") as f:
-        json.dump(metadata, f)
+    try:
+        if store and store.checkout(pdf_filepath, pmid=pmid, doi=doi):
+            if ledger:
+                ledger.record_success(pmid)
+            return pdf_filepath
+    except Exception as e:
+        logger.warning("Link %s from the pdf store failed, reason: %s" % (pmid, e))
+
+    # The backoff only skips the downloads, a paper in the store is free.
+    sources = resolver.get_sources(article)
+    if ledger and not retry_failed and not ledger.should_retry(pmid, sources):
+        failure = ledger.get(pmid)
+        logger.info(
+            "Skip %s, it failed %s times (%s), the next retry is at %s."
+            % (
+                pmid,
+                failure["attempts"],
+                failure["reason"],
+                datetime.fromtimestamp(failure["retry_at"]).strftime(
+                    "%Y-%m-%d %H:%M:%S"
+                ),
+            )
+        )
+        return None
+
+    reason = None
+    try:
+        source = resolver.resolve(article, pdf_filepath)
+        if source is None:
+            logger.info("Cannot find the full text for %s" % pmid)
+            reason = "not found" if sources else "no pmcid or doi"
+        else:
+            logger.info("Download %s from %s." % (pmid, source))
+    except Exception as e:
+        logger.warning("Download %s failed, reason: %s" % (pmid, e))
+        reason = str(e)
+
+    if os.path.exists(pdf_filepath):
+        valid, invalid_reason = (
+            manifest.check(pdf_filepath) if manifest else (True, None)
+        )
+        if not valid:
+            logger.warning(
+                "%s is not a valid pdf (%s), remove it."
+                % (pdf_filepath, invalid_reason)
+            )
+            os.remove(pdf_filepath)
+            reason = "invalid pdf, %s" % invalid_reason
+
+    if not os.path.exists(pdf_filepath):
+        if ledger:
+            ledger.record_failure(pmid, reason or "not found", sources)
+        return None
+
+    if ledger:
+        ledger.record_success(pmid)
+    if store:
+        store.add(pdf_filepath, pmid=pmid, doi=doi)
+    return pdf_filepath
+
+
+def convert_pdf(pdf_filepath, html_filepath, store=None):
+    if os.path.exists(html_filepath):
+        return True
+
+    try:
+        html_dir = os.path.dirname(html_filepath)
+        if store:
+            os.makedirs(html_dir, exist_ok=True)
+            if store.checkout_html(pdf_filepath, html_filepath):
+                return True
+
+        converted = pdf_to_html(html_dir, pdf_filepath)
+        if converted and store:
+            store.add_html(pdf_filepath, html_filepath)
+        return converted
+    except Exception as e:
+        logger.warning(
+            "Cannot convert %s to html. Please check the following messages: %s"
+            % (pdf_filepath, e)
+        )
+        return False
+
+
+def update_metadata(article, pmid, pdf_filepath, html_filepath):
+    if os.path.isfile(pdf_filepath):
+        pdf_url = "https://publications.3steps.cn/publications/pdf/%s.pdf" % pmid
+        article[
+            "pdf"
+        ] = f"<embed src='{pdf_url}' width='100%' height='600px' type='application/pdf'>"
+
+    # if os.path.isfile(html_filepath):
+    #     article["html"] = 's3://publications/html/%s.html' % pmid
+    article["html"] = "s3://publications/html/%s.html" % pmid
+
+
+class MetadataUpdater(object):
+    """Update the full text fields of the articles in a metadata file.
+
+    The articles are found by pmid and the updates are written back in
+    batches, every `flush_every` updates or `flush_interval` seconds, and when
+    it is closed. The file is replaced atomically, so it is never half written.
+
+    Steps:
+        with MetadataUpdater(metadata, metadata_file) as updater:
+            updater.update(pmid, pdf_filepath, html_filepath)
+    """
+
+    def __init__(
+        self,
+        metadata,
+        metadata_file,
+        flush_every=METADATA_FLUSH_EVERY,
+        flush_interval=METADATA_FLUSH_INTERVAL,
+    ):
+        self.metadata = metadata
+        self.metadata_file = metadata_file
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.articles = {}
+        for article in metadata:
+            self.articles.setdefault(article.get("pmid"), []).append(article)
+        self.updates = 0
+        self.flushed_at = time.monotonic()
+
+    def mark_changed(self, count=1):
+        """Record the changes which are made to the articles directly."""
+        self.updates += count
+
+    def update(self, pmid, pdf_filepath, html_filepath):
+        for article in self.articles.get(pmid, []):
+            update_metadata(article, pmid, pdf_filepath, html_filepath)
+
+        self.updates += 1
+        if (
+            self.updates >= self.flush_every
+            or time.monotonic() - self.flushed_at >= self.flush_interval
+        ):
+            self.flush()
+
+    def flush(self):
+        if not self.updates:
+            return
+
+        dirname = os.path.dirname(os.path.abspath(self.metadata_file))
+        fd, tmp_file = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=dirname)
+        try:
+            with os.fdopen(fd, "w") as f:
+                if self.metadata_file.endswith(".ndjson"):
+                    for article in self.metadata:
+                        f.write(json.dumps(article) + "\n")
+                else:
+                    json.dump(self.metadata, f)
+            os.replace(tmp_file, self.metadata_file)
+        except BaseException:
+            os.remove(tmp_file)
+            raise
+
+        logger.info("Save %s updates to %s." % (self.updates, self.metadata_file))
+        self.updates = 0
+        self.flushed_at = time.monotonic()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
 
 @pubmed.command(help="Fetch the full text for articles.")
@@ -730,8 +1300,140 @@ def update_metadata(pmid, metadata, metadata_file, pdf_filepath, html_filepath):
     default="/var/log/paper-downloader.log",
     help="Where is the log file.",
 )
-def fetch_pdf(metadata_file, output_dir, logpath):
+@click.option(
+    "--workers",
+    "-w",
+    required=False,
+    type=click.IntRange(1),
+    default=1,
+    help="How many articles are downloaded at the same time.",
+)
+@click.option(
+    "--per-host",
+    required=False,
+    type=click.IntRange(1),
+    default=None,
+    help="How many downloads can be sent to one host (e.g. a sci-hub mirror) at the same time. It is %s by default, except %s. If it is set, it is used for every host."
+    % (
+        DEFAULT_HOST_CONCURRENCY,
+        ", ".join("%s for %s" % (n, host) for host, n in HOST_CONCURRENCY.items()),
+    ),
+)
+@click.option(
+    "--convert-workers",
+    required=False,
+    type=click.IntRange(1),
+    default=1,
+    help="How many pdfs are converted to html at the same time.",
+)
+@click.option(
+    "--cache-dir",
+    required=False,
+    envvar="PFETCHER_CACHE_DIR",
+    default=None,
+    help="Where is the http response cache, it is ~/.cache/paper-downloader by default and can also be set by the PFETCHER_CACHE_DIR environment variable.",
+)
+@click.option(
+    "--cache-size",
+    required=False,
+    envvar="PFETCHER_CACHE_SIZE",
+    type=click.IntRange(1),
+    default=1024,
+    help="The max size (MB) of the http response cache.",
+)
+@click.option(
+    "--no-cache",
+    required=False,
+    is_flag=True,
+    default=False,
+    help="Whether disable the http response cache.",
+)
+@click.option(
+    "--store-dir",
+    required=False,
+    envvar="PFETCHER_STORE_DIR",
+    default=None,
+    help="A pdf store shared by several projects, the pdfs and htmls in it are reused instead of being downloaded and converted again. It can also be set by the PFETCHER_STORE_DIR environment variable.",
+)
+@click.option(
+    "--sources",
+    required=False,
+    default="pmc,europepmc,unpaywall,doi,scihub",
+    help="Where to find the pdfs, a comma separated list of pmc, europepmc, unpaywall, doi and scihub. The order of the sources is learned for every publisher.",
+)
+@click.option(
+    "--hedge-delay",
+    required=False,
+    type=click.FloatRange(0),
+    default=10,
+    help="Start the next source if the pdf is not found after the seconds.",
+)
+@click.option(
+    "--email",
+    required=False,
+    envvar="PFETCHER_EMAIL",
+    default=None,
+    help="Your email, the unpaywall source needs it. It can also be set by the PFETCHER_EMAIL environment variable.",
+)
+@click.option(
+    "--retry-failed",
+    required=False,
+    is_flag=True,
+    default=False,
+    help="Retry all the papers which failed before. By default a failed paper is retried after 1, 2, 4... hours.",
+)
+@click.option(
+    "--refresh-ids/--no-refresh-ids",
+    required=False,
+    default=True,
+    help="Whether update the pmcids and dois of the articles by the NCBI ID Converter before downloading.",
+)
+@click.option(
+    "--metrics-file",
+    required=False,
+    default=None,
+    help="Save the download metrics (bytes, time to first byte, total time, outcome and retries per source and host) into a json file.",
+)
+def fetch_pdf(
+    metadata_file,
+    output_dir,
+    logpath,
+    workers,
+    per_host,
+    convert_workers,
+    cache_dir,
+    cache_size,
+    no_cache,
+    store_dir,
+    sources,
+    hedge_delay,
+    email,
+    retry_failed,
+    refresh_ids,
+    metrics_file,
+):
+    from paper_downloader.resolvers import PdfResolver
+    from paper_downloader.idconv import refresh_ids as refresh_article_ids
+
     set_log(logpath)
+    if per_host:
+        set_host_limiter(
+            default=per_host, limits={host: per_host for host in HOST_CONCURRENCY}
+        )
+    metrics = reset_metrics()
+    if workers > client.DEFAULT_POOL_MAXSIZE:
+        client.configure(pool_maxsize=workers)
+    cache = (
+        None if no_cache else ResponseCache(cache_dir, max_size=cache_size * 1024 * 1024)
+    )
+    store = PdfStore(store_dir) if store_dir else None
+    resolver = PdfResolver(
+        [source.strip() for source in sources.split(",") if source.strip()],
+        cache=cache,
+        email=email,
+        hedge_delay=hedge_delay,
+        cache_dir=cache_dir,
+    )
 
     if not os.path.exists(metadata_file):
         logger.warning("Cannot find the metadata file.")
@@ -747,55 +1449,63 @@ def fetch_pdf(metadata_file, output_dir, logpath):
         logger.warning("Cannot find the metadata file.")
         raise Exception("Cannot find the metadata file.")
 
-    copied_metadata = copy.deepcopy(metadata)
-    for i in metadata:
-        pmcid = i.get("pmcid")
-        pmid = i.get("pmid")
-        scihub = i.get("doi")
-
-        pdf_filepath = os.path.join(output_dir, str(pmid) + ".pdf")
-        html_filepath = pdf_filepath.replace("pdf", "html")
-        if os.path.exists(pdf_filepath):
-            logger.info("%s.pdf exists in %s, skip it." % (pmid, output_dir))
+    def get_filepaths(article):
+        pdf_filepath = os.path.join(output_dir, str(article.get("pmid")) + ".pdf")
+        return pdf_filepath, pdf_filepath.replace("pdf", "html")
 
-            if not os.path.exists(html_filepath):
+    # The downloads and the conversions run in their own pools, a pdf is
+    # converted as soon as it is downloaded.
+    manifest = PdfManifest(os.path.join(output_dir, PDF_MANIFEST_FILE))
+    ledger = FailureLedger(os.path.join(output_dir, FAILURES_FILE))
+    # The manifest, the source stats and the failures are saved even if the
+    # run is interrupted.
+    try:
+        with MetadataUpdater(metadata, metadata_file) as updater, ThreadPoolExecutor(
+            max_workers=workers
+        ) as downloader, ThreadPoolExecutor(max_workers=convert_workers) as converter:
+            if refresh_ids:
+                # New PMC articles get a pmcid after the metadata is fetched.
                 try:
-                    pdf_to_html(
-                        os.path.dirname(html_filepath),
-                        os.path.join(output_dir, pdf_filepath),
-                    )
+                    updater.mark_changed(refresh_article_ids(metadata, email, cache))
                 except Exception as e:
-                    logger.warning(
-                        "Cannot convert %s.pdf to html. Please check the following messages: %s"
-                        % (pmid, e)
-                    )
-
-            update_metadata(
-                pmid, copied_metadata, metadata_file, pdf_filepath, html_filepath
-            )
-            continue
+                    logger.warning("Cannot refresh the ids, reason: %s" % e)
+
+            pending = {
+                downloader.submit(
+                    download_pdf,
+                    i,
+                    output_dir,
+                    resolver,
+                    store,
+                    manifest,
+                    ledger,
+                    retry_failed,
+                ): ("download", i)
+                for i in metadata
+            }
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, article = pending.pop(future)
+                    pdf_filepath, html_filepath = get_filepaths(article)
+                    if stage == "download" and future.result():
+                        future = converter.submit(
+                            convert_pdf, pdf_filepath, html_filepath, store
+                        )
+                        pending[future] = ("convert", article)
+                        continue
 
-        if pmcid:
-            logger.info("Download %s from PMC." % pmid)
-            download_pmc(pmcid, pdf_filepath)
-            logger.info("\n\n")
-        elif scihub:
-            logger.info("Download %s from scihub." % pmid)
-            sh = SciHub()
-            sh.download(scihub, destination=output_dir, path=str(pmid) + ".pdf")
-        else:
-            logger.info("Cannot find the full text for %s" % pmid)
+                    updater.update(article.get("pmid"), pdf_filepath, html_filepath)
+    finally:
+        manifest.save()
+        resolver.close()
+        logger.info("%s papers cannot be downloaded yet." % ledger.count())
+        ledger.close()
 
-        try:
-            pdf_to_html(
-                os.path.dirname(html_filepath), os.path.join(output_dir, pdf_filepath)
-            )
-        except Exception as e:
-            logger.warning("Cannot convert %s.pdf to html." % pmid)
-
-        update_metadata(
-            pmid, copied_metadata, metadata_file, pdf_filepath, html_filepath
-        )
+        logger.info("Download metrics:\n%s" % metrics.summary())
+        if metrics_file:
+            metrics.dump(metrics_file)
+            logger.info("Save the download metrics into %s." % metrics_file)
 
 
 @pubmed.command(help="Convert pdf to html.")
@@ -812,13 +1522,22 @@ def fetch_pdf(metadata_file, output_dir, logpath):
     default="/var/log/paper-downloader.log",
     help="Where is the log file.",
 )
-def pdf2html(pdf_dir, html_dir, logpath):
+@click.option(
+    "--store-dir",
+    required=False,
+    envvar="PFETCHER_STORE_DIR",
+    default=None,
+    help="A pdf store shared by several projects, the html of the same pdf is reused. It can also be set by the PFETCHER_STORE_DIR environment variable.",
+)
+def pdf2html(pdf_dir, html_dir, logpath, store_dir):
     set_log(logpath)
+    store = PdfStore(store_dir) if store_dir else None
 
     pdf_dir = os.path.abspath(pdf_dir)
     html_dir = os.path.abspath(html_dir)
     if not os.path.exists(html_dir):
         os.makedirs(html_dir)
+    manifest = PdfManifest(os.path.join(pdf_dir, PDF_MANIFEST_FILE))
     pdfs = [os.path.join(pdf_dir, i) for i in os.listdir(pdf_dir) if i.endswith(".pdf")]
     for pdf in pdfs:
         logger.info("Convert pdf (%s) to html." % pdf)
@@ -828,12 +1547,144 @@ def pdf2html(pdf_dir, html_dir, logpath):
             logger.info("Skip %s" % pdf)
             continue
 
+        valid, reason = manifest.check(pdf)
+        if not valid:
+            logger.warning("Skip %s, it is not a valid pdf (%s)." % (pdf, reason))
+            continue
+
         try:
-            pdf_to_html(html_dir, pdf)
+            if store and store.checkout_html(pdf, html_file):
+                continue
+
+            if pdf_to_html(html_dir, pdf) and store:
+                store.add_html(pdf, html_file)
         except Exception as e:
             logger.error(e)
             logger.error("Convert %s failed." % pdf)
             continue
+    manifest.save()
+
+
+@pubmed.command(help="Ingest the metadata from local PubMed baseline/update files.")
+@click.option(
+    "--baseline-dir",
+    "-b",
+    required=True,
+    type=click.Path(exists=True, file_okay=False, dir_okay=True),
+    help="The directory which saved the PubMed baseline/update files (*.xml.gz or *.xml).",
+)
+@click.option(
+    "--output-file", "-o", required=True, help="The file which saved the metadata."
+)
+@click.option(
+    "--pmids-file",
+    "-p",
+    required=False,
+    default=None,
+    type=click.Path(exists=True, file_okay=True, dir_okay=False),
+    help="Only ingest the pmids in this file (separated by whitespaces or commas).",
+)
+@click.option(
+    "--keyword",
+    "-k",
+    required=False,
+    multiple=True,
+    help="Only ingest the articles whose title or abstract contains one of the keywords.",
+)
+@click.option(
+    "--author", "-a", required=False, default="Anonymous", help="The tag of articles."
+)
+@click.option(
+    "--workers",
+    "-w",
+    required=False,
+    type=click.IntRange(1, 64),
+    default=1,
+    help="How many processes? Each process parses one file at a time.",
+)
+@click.option(
+    "--logpath",
+    "-l",
+    required=False,
+    default="/var/log/paper-downloader.log",
+    help="Where is the log file.",
+)
+def ingest_baseline(
+    baseline_dir, output_file, pmids_file, keyword, author, workers, logpath
+):
+    from paper_downloader import baseline
+
+    set_log(logpath)
+
+    output_file = os.path.abspath(output_file)
+    if os.path.exists(output_file):
+        raise Exception("%s does exist, please delete it and retry." % output_file)
+
+    if not os.path.exists(os.path.dirname(output_file)):
+        os.makedirs(os.path.dirname(output_file))
+
+    pmids = None
+    if pmids_file:
+        pmids = re.split(r"[\s,]+", read_file_as_text(pmids_file).strip())
+        if not all(pmid.isdigit() for pmid in pmids):
+            raise Exception("Please check your pmids file, it contains invalid pmids.")
+
+    baseline_dir = os.path.abspath(baseline_dir)
+    files = [
+        os.path.join(baseline_dir, i)
+        for i in os.listdir(baseline_dir)
+        if i.endswith(".xml.gz") or i.endswith(".xml")
+    ]
+    logger.info("Ingest the metadata from %s files..." % len(files))
+    count = baseline.ingest_baseline(
+        files,
+        output_file,
+        pmids=pmids,
+        keywords=keyword,
+        author=author,
+        workers=workers,
+        get_impact_factor_fn=ImpactFactor(),
+    )
+    logger.info("Ingest %s articles into %s." % (count, output_file))
+
+
+@pubmed.command(help="Export the metadata files into a parquet dataset.")
+@click.option(
+    "--metadata-dir",
+    "-m",
+    required=True,
+    type=click.Path(exists=True, file_okay=False, dir_okay=True),
+    help="The directory which saved the metadata files.",
+)
+@click.option(
+    "--output-dir",
+    "-o",
+    required=True,
+    help="The directory which saved the parquet dataset, only the new articles are appended to it.",
+)
+@click.option(
+    "--logpath",
+    "-l",
+    required=False,
+    default="/var/log/paper-downloader.log",
+    help="Where is the log file.",
+)
+def export_parquet(metadata_dir, output_dir, logpath):
+    from paper_downloader.export import export_parquet_dataset
+
+    set_log(logpath)
+
+    metadata_dir = os.path.abspath(metadata_dir)
+    files = [
+        os.path.join(metadata_dir, i)
+        for i in sorted(os.listdir(metadata_dir))
+        if i.endswith(".json") or i.endswith(".ndjson")
+    ]
+    part_file = export_parquet_dataset(files, os.path.abspath(output_dir))
+    if part_file:
+        logger.info("Export the metadata into %s." % part_file)
+    else:
+        logger.info("No new articles need to be exported.")
 
 
 @pubmed.command(help="Convert bib file to a paper-downloader input file.")
@@ -874,11 +1725,24 @@ def bib2pd(bib_file, output_file, logpath, download_pdf=False):
                 url = article.get("url")
                 if url:
                     if "pubmed" in url:
-                        pmid = url.split("/")[-1]
+                        pmid = url.rstrip("/").split("/")[-1]
                         pmids.append(pmid)
 
+            # fetch-metadata rejects the invalid pmids, e.g. from a url like
+            # https://pubmed.ncbi.nlm.nih.gov/?term=...
+            pmids = list(
+                dict.fromkeys(
+                    str(pmid).strip()
+                    for pmid in pmids
+                    if str(pmid).strip().isdigit()
+                )
+            )
             query_str = " OR ".join(pmids)
-            output = {"query_str": query_str, "download_pdf": download_pdf}
+            output = {
+                "query_str": query_str,
+                "pmids": pmids,
+                "download_pdf": download_pdf,
+            }
 
             write_json(output, output_file)
     except Exception as e:
@@ -0,0 +1,315 @@
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from paper_downloader.metrics import get_metrics
+
+# How many hosts keep a connection pool, and how many connections are kept
+# alive for each host.
+DEFAULT_POOL_CONNECTIONS = int(os.environ.get("PFETCHER_HTTP_POOL_CONNECTIONS", 20))
+DEFAULT_POOL_MAXSIZE = int(os.environ.get("PFETCHER_HTTP_POOL_MAXSIZE", 10))
+# (connect timeout, read timeout) in seconds.
+DEFAULT_TIMEOUT = (
+    float(os.environ.get("PFETCHER_HTTP_CONNECT_TIMEOUT", 10)),
+    float(os.environ.get("PFETCHER_HTTP_READ_TIMEOUT", 60)),
+)
+
+# Read the response body in 64 KB chunks, so a download never keeps the
+# whole file in memory.
+CHUNK_SIZE = 64 * 1024
+
+
+class DownloadCancelled(Exception):
+    pass
+
+
+_config = {
+    "pool_connections": DEFAULT_POOL_CONNECTIONS,
+    "pool_maxsize": DEFAULT_POOL_MAXSIZE,
+    "timeout": DEFAULT_TIMEOUT,
+}
+_adapter = None
+_session = None
+_lock = threading.Lock()
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """An HTTPAdapter with a default timeout for every request."""
+
+    def __init__(self, timeout=None, **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super().send(request, **kwargs)
+
+
+def configure(pool_connections=None, pool_maxsize=None, timeout=None):
+    """Change the pool sizes or the timeout, the existing pools are replaced."""
+    global _adapter, _session
+
+    with _lock:
+        if pool_connections is not None:
+            _config["pool_connections"] = pool_connections
+        if pool_maxsize is not None:
+            _config["pool_maxsize"] = pool_maxsize
+        if timeout is not None:
+            _config["timeout"] = timeout
+
+        if _adapter is not None:
+            _adapter.close()
+        _adapter = None
+        _session = None
+
+
+def get_adapter():
+    """Get the process-wide adapter, which keeps one connection pool per host."""
+    global _adapter
+
+    with _lock:
+        if _adapter is None:
+            _adapter = TimeoutHTTPAdapter(
+                timeout=_config["timeout"],
+                pool_connections=_config["pool_connections"],
+                pool_maxsize=_config["pool_maxsize"],
+            )
+        return _adapter
+
+
+def make_session():
+    """Make a new session which reuses the shared connection pools.
+
+    The session has its own headers, cookies and proxies, but the TCP/TLS
+    connections are kept alive and shared with all the other sessions.
+    """
+    adapter = get_adapter()
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session():
+    """Get the process-wide session."""
+    global _session
+
+    session = _session
+    if session is None:
+        session = make_session()
+        with _lock:
+            if _session is None:
+                _session = session
+            session = _session
+    return session
+
+
+def request(method, url, session=None, **kwargs):
+    """Send a request by the shared session, or by session if it is set.
+
+    Every request is recorded in the download metrics, the bytes of a
+    streamed response are taken from its Content-Length.
+    """
+    session = session or get_session()
+    started_at = time.monotonic()
+    try:
+        res = session.request(method, url, **kwargs)
+    except Exception:
+        get_metrics().record(url, "error", total=time.monotonic() - started_at)
+        raise
+
+    if kwargs.get("stream"):
+        size = int(res.headers.get("Content-Length") or 0)
+    else:
+        size = len(res.content)
+    get_metrics().record(
+        url,
+        "ok" if res.status_code < 400 else "http %s" % res.status_code,
+        size,
+        res.elapsed.total_seconds(),
+        time.monotonic() - started_at,
+    )
+    return res
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+def _read_part_state(state_file):
+    try:
+        with open(state_file, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _remove_part(part_file, state_file):
+    for filename in [part_file, state_file]:
+        if os.path.exists(filename):
+            os.remove(filename)
+
+
+def _hash_file(filename, hashes, chunk_size=CHUNK_SIZE):
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            for h in hashes:
+                h.update(chunk)
+
+
+def _content_range_start(response):
+    match = re.match(r"bytes (\d+)-", response.headers.get("Content-Range", ""))
+    return int(match.group(1)) if match else None
+
+
+def download_file(
+    url,
+    path,
+    session=None,
+    check_response=None,
+    chunk_size=CHUNK_SIZE,
+    cancelled=None,
+    **kwargs
+):
+    """Stream a url into path, resume the partial download if there is one.
+
+    The body is written into <path>.part in chunks and the md5/sha256 digests
+    are computed on the fly, so the memory doesn't grow with the file. The
+    ETag/Last-Modified of the response are saved in <path>.part.json, the next
+    call sends a Range request with If-Range and only downloads the rest of
+    the file if the server supports it. The file is moved to path when it is
+    complete, so path is never a truncated file.
+
+    Args:
+        check_response: a function which gets the response and returns False
+            if the body should not be saved, e.g. it is not a pdf.
+        cancelled: a threading.Event, DownloadCancelled is raised when it is
+            set and the partial file is removed.
+
+    Every request is recorded in the download metrics.
+
+    Returns:
+        dict: the size, md5, sha256 of the file and the resumed bytes, None
+            if check_response rejects the response.
+    """
+    session = session or get_session()
+    part_file = path + ".part"
+    state_file = part_file + ".json"
+
+    request_headers = kwargs.pop("headers", None) or {}
+    headers = dict(request_headers)
+    offset = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+    state = _read_part_state(state_file)
+    validator = state.get("etag") or state.get("last_modified")
+    if offset and state.get("url") == url and validator:
+        headers["Range"] = "bytes=%s-" % offset
+        headers["If-Range"] = validator
+    else:
+        offset = 0
+
+    metrics = get_metrics()
+    started_at = time.monotonic()
+    ttfb = None
+    size = offset
+    outcome = "error"
+    try:
+        with session.get(url, headers=headers, stream=True, **kwargs) as res:
+            ttfb = time.monotonic() - started_at
+            if offset and (
+                res.status_code == 416
+                or (res.status_code == 206 and _content_range_start(res) != offset)
+            ):
+                # The partial file is not valid anymore, or the server sent
+                # another range than the one after it, download it again.
+                outcome = "http 416" if res.status_code == 416 else "range mismatch"
+                _remove_part(part_file, state_file)
+                res.close()
+                return download_file(
+                    url,
+                    path,
+                    session,
+                    check_response,
+                    chunk_size,
+                    cancelled,
+                    headers=request_headers,
+                    **kwargs
+                )
+
+            if check_response and not check_response(res):
+                outcome = (
+                    "http %s" % res.status_code
+                    if res.status_code >= 400
+                    else "rejected"
+                )
+                return None
+
+            md5 = hashlib.md5()
+            sha256 = hashlib.sha256()
+            if res.status_code == 206:
+                if not offset:
+                    outcome = "http 206"
+                    raise Exception(
+                        "%s sent a partial response without a Range request." % url
+                    )
+                _hash_file(part_file, [md5, sha256], chunk_size)
+                mode = "ab"
+            else:
+                offset = 0
+                size = 0
+                mode = "wb"
+                _remove_part(part_file, state_file)
+                state = {
+                    "url": url,
+                    "etag": res.headers.get("ETag"),
+                    "last_modified": res.headers.get("Last-Modified"),
+                }
+                # Weak ETags cannot be used by If-Range.
+                if state["etag"] and state["etag"].startswith("W/"):
+                    state["etag"] = None
+                if state["etag"] or state["last_modified"]:
+                    with open(state_file, "w") as f:
+                        json.dump(state, f)
+
+            with open(part_file, mode) as f:
+                for chunk in res.iter_content(chunk_size=chunk_size):
+                    if cancelled is not None and cancelled.is_set():
+                        f.close()
+                        _remove_part(part_file, state_file)
+                        outcome = "cancelled"
+                        raise DownloadCancelled(
+                            "The download of %s is cancelled." % url
+                        )
+                    if chunk:
+                        f.write(chunk)
+                        md5.update(chunk)
+                        sha256.update(chunk)
+                        size += len(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+
+        os.replace(part_file, path)
+        if os.path.exists(state_file):
+            os.remove(state_file)
+        outcome = "ok"
+    finally:
+        metrics.record(
+            url, outcome, size - offset, ttfb, time.monotonic() - started_at
+        )
+
+    return {
+        "size": size,
+        "md5": md5.hexdigest(),
+        "sha256": sha256.hexdigest(),
+        "resumed": offset,
+    }
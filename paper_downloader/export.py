@@ -0,0 +1,156 @@
+import os
+import json
+import logging
+from datetime import datetime
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    raise ImportError(
+        "export-parquet needs pyarrow, please install it by "
+        "`pip install paper-downloader[parquet]` or `pip install pyarrow`."
+    )
+
+logger = logging.getLogger("paper-downloader")
+
+# The same fields as the records from PubMed.make_paper, the repeated
+# strings (tag, journal) are dictionary encoded, i.e. pandas categories.
+METADATA_SCHEMA = pa.schema(
+    [
+        ("pmid", pa.int64()),
+        ("tag", pa.dictionary(pa.int32(), pa.string())),
+        ("pmcid", pa.string()),
+        ("pmc_link", pa.string()),
+        ("pubmed_link", pa.string()),
+        ("abstract", pa.string()),
+        ("title", pa.string()),
+        ("imported_date", pa.date32()),
+        ("authors", pa.string()),
+        ("journal_abbr", pa.dictionary(pa.int32(), pa.string())),
+        ("journal", pa.dictionary(pa.int32(), pa.string())),
+        ("pdf", pa.string()),
+        ("html", pa.string()),
+        ("impact_factor", pa.float64()),
+        ("publication", pa.int32()),
+        ("doi", pa.string()),
+        ("doi_link", pa.string()),
+    ]
+)
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_date(value):
+    try:
+        return datetime.strptime(str(value), "%Y-%m-%d").date()
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_str(value):
+    return None if value is None else str(value)
+
+
+CONVERTERS = {
+    pa.int64(): _to_int,
+    pa.int32(): _to_int,
+    pa.float64(): _to_float,
+    pa.date32(): _to_date,
+}
+
+
+def records_to_table(records):
+    """Convert the metadata records into an arrow table sorted by pmid."""
+    records = sorted(records, key=lambda record: record["pmid"])
+    columns = []
+    for field in METADATA_SCHEMA:
+        convert = CONVERTERS.get(field.type, _to_str)
+        values = [convert(record.get(field.name)) for record in records]
+        if pa.types.is_dictionary(field.type):
+            column = pa.array(values, type=pa.string()).dictionary_encode()
+        else:
+            column = pa.array(values, type=field.type)
+        columns.append(column)
+    return pa.Table.from_arrays(columns, schema=METADATA_SCHEMA)
+
+
+def read_records(filename):
+    with open(filename, "r") as f:
+        if filename.endswith(".ndjson"):
+            return [json.loads(line) for line in f if line.strip()]
+        return json.load(f)
+
+
+def read_dataset_pmids(dataset_dir):
+    """Read the pmids of a parquet dataset, only the pmid column is loaded."""
+    pmids = set()
+    for filename in os.listdir(dataset_dir):
+        if filename.endswith(".parquet"):
+            table = pq.read_table(os.path.join(dataset_dir, filename), columns=["pmid"])
+            pmids.update(table.column("pmid").to_pylist())
+    return pmids
+
+
+def export_parquet_dataset(files, dataset_dir, row_group_size=100000):
+    """Append the new articles of the metadata files to a parquet dataset.
+
+    Every export writes one part file which only contains the pmids that are
+    not in the dataset yet. The rows are sorted by pmid, so readers can skip
+    row groups by the pmid statistics, e.g.
+
+        pandas.read_parquet(dataset_dir, filters=[("pmid", ">", 30000000)])
+
+    Returns:
+        str: the new part file, None if there is no new article.
+    """
+    if not os.path.exists(dataset_dir):
+        os.makedirs(dataset_dir)
+
+    exported_pmids = read_dataset_pmids(dataset_dir)
+    records = {}
+    for file in files:
+        try:
+            articles = read_records(file)
+        except Exception as e:
+            logger.error("Load %s error, reason: %s" % (file, e))
+            continue
+
+        if type(articles) != list:
+            continue
+
+        for article in articles:
+            pmid = _to_int(article.get("pmid")) if type(article) == dict else None
+            if pmid is None or pmid in exported_pmids or pmid in records:
+                continue
+            records[pmid] = dict(article, pmid=pmid)
+
+    logger.info(
+        "Find %s new articles, %s articles are already in %s."
+        % (len(records), len(exported_pmids), dataset_dir)
+    )
+    if not records:
+        return None
+
+    table = records_to_table(records.values())
+    part_file = os.path.join(
+        dataset_dir, "part-%s.parquet" % datetime.now().strftime("%Y%m%d%H%M%S%f")
+    )
+    tmp_file = part_file + ".tmp"
+    pq.write_table(
+        table, tmp_file, row_group_size=row_group_size, compression="zstd"
+    )
+    os.replace(tmp_file, part_file)
+    return part_file
@@ -0,0 +1,104 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger("paper-downloader")
+
+FAILURES_FILE = ".download_failures.sqlite"
+# A failed paper is retried after 1 hour, then 2, 4, 8 hours... up to 30 days.
+RETRY_BASE_SECONDS = 60 * 60
+RETRY_MAX_SECONDS = 30 * 24 * 60 * 60
+
+
+class FailureLedger(object):
+    """Remember the papers which cannot be downloaded.
+
+    Every failure is saved with its reason, the sources which were tried and
+    the attempts, and the paper is skipped until its next retry time, which
+    doubles after every failed attempt. A paper is retried at once when its
+    sources change, e.g. it gets a pmcid.
+
+    Steps:
+        ledger = FailureLedger("pdf/.download_failures.sqlite")
+        if ledger.should_retry(pmid, sources):
+            ... download it ...
+            ledger.record_failure(pmid, "not found", sources)  # or
+            ledger.record_success(pmid)
+    """
+
+    def __init__(
+        self,
+        path,
+        base_seconds=RETRY_BASE_SECONDS,
+        max_seconds=RETRY_MAX_SECONDS,
+    ):
+        self.path = os.path.abspath(path)
+        self.base_seconds = base_seconds
+        self.max_seconds = max_seconds
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS failures (
+                pmid TEXT PRIMARY KEY,
+                reason TEXT,
+                sources TEXT,
+                attempts INTEGER NOT NULL,
+                failed_at REAL NOT NULL,
+                retry_at REAL NOT NULL
+            );
+            """
+        )
+
+    def get(self, pmid):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT reason, sources, attempts, failed_at, retry_at "
+                "FROM failures WHERE pmid = ?",
+                (str(pmid),),
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(
+            zip(["reason", "sources", "attempts", "failed_at", "retry_at"], row)
+        )
+
+    def should_retry(self, pmid, sources=None):
+        failure = self.get(pmid)
+        if failure is None:
+            return True
+        if sources is not None and failure["sources"] != ",".join(sources):
+            return True
+        return failure["retry_at"] <= time.time()
+
+    def record_failure(self, pmid, reason, sources=None):
+        failure = self.get(pmid)
+        attempts = failure["attempts"] + 1 if failure else 1
+        now = time.time()
+        delay = min(self.base_seconds * 2 ** (attempts - 1), self.max_seconds)
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO failures VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    str(pmid),
+                    reason,
+                    ",".join(sources or []),
+                    attempts,
+                    now,
+                    now + delay,
+                ),
+            )
+        return attempts
+
+    def record_success(self, pmid):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM failures WHERE pmid = ?", (str(pmid),))
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM failures").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,91 @@
+import json
+import logging
+
+from paper_downloader import client
+from paper_downloader.ratelimit import get_ncbi_limiter, get_host_limiter
+
+logger = logging.getLogger("paper-downloader")
+
+# https://www.ncbi.nlm.nih.gov/pmc/tools/id-converter-api/
+IDCONV_URL = "https://www.ncbi.nlm.nih.gov/pmc/utils/idconv/v1.0/"
+# The ID Converter accepts at most 200 ids per request.
+IDCONV_BATCH_SIZE = 200
+
+
+def convert_pmids(pmids, email=None, cache=None, batch_size=IDCONV_BATCH_SIZE):
+    """Get the pmcids and dois of the pmids from the NCBI ID Converter.
+
+    Returns:
+        dict: {pmid: {"pmcid": ..., "doi": ...}}, the pmids which are not in
+            PMC are missing.
+    """
+    pmids = sorted(set(str(pmid) for pmid in pmids if str(pmid).isdigit()))
+    limiter = get_ncbi_limiter()
+    results = {}
+    for i in range(0, len(pmids), batch_size):
+        params = {
+            "ids": ",".join(pmids[i : i + batch_size]),
+            "idtype": "pmid",
+            "format": "json",
+            "tool": "paper-downloader",
+        }
+        if email:
+            params["email"] = email
+
+        content = cache.get("idconv", IDCONV_URL, params) if cache else None
+        if content is None:
+            limiter.acquire()
+            with get_host_limiter().slot(IDCONV_URL):
+                res = client.get(IDCONV_URL, params=params)
+            if res.status_code != 200:
+                logger.warning(
+                    "Convert the ids failed, status code is %s." % res.status_code
+                )
+                continue
+            content = res.content
+            if cache:
+                cache.set("idconv", IDCONV_URL, params, content)
+
+        for record in json.loads(content).get("records", []):
+            if record.get("status") == "error" or not record.get("pmid"):
+                continue
+            results[str(record["pmid"])] = {
+                "pmcid": record.get("pmcid") or "",
+                "doi": record.get("doi") or "",
+            }
+    return results
+
+
+def refresh_ids(metadata, email=None, cache=None):
+    """Fill the missing or stale pmcid/doi fields of the metadata records.
+
+    Returns:
+        int: how many records are changed.
+    """
+    ids = convert_pmids(
+        [article.get("pmid") for article in metadata], email=email, cache=cache
+    )
+    changed = 0
+    for article in metadata:
+        found = ids.get(str(article.get("pmid")))
+        if not found:
+            continue
+
+        updated = False
+        if found["pmcid"] and article.get("pmcid") != found["pmcid"]:
+            article["pmcid"] = found["pmcid"]
+            article["pmc_link"] = (
+                "https://www.ncbi.nlm.nih.gov/pmc/articles/" + found["pmcid"]
+            )
+            updated = True
+        if found["doi"] and not article.get("doi"):
+            article["doi"] = found["doi"]
+            article["doi_link"] = "https://doi.org/" + found["doi"]
+            updated = True
+        changed += updated
+
+    logger.info(
+        "Find %s articles in PMC, update the ids of %s articles."
+        % (len(ids), changed)
+    )
+    return changed
@@ -0,0 +1,128 @@
+import os
+import json
+import sqlite3
+import logging
+
+logger = logging.getLogger("paper-downloader")
+
+PMID_INDEX_FILE = ".pmid_index.sqlite"
+
+
+class PmidIndex(object):
+    """An on-disk index of the pmids in the metadata files of a directory.
+
+    It maps every pmid to the metadata files which contain it, and remembers
+    the size and mtime of each indexed file, so a metadata file is only
+    loaded again when it is new or has changed.
+
+    Steps:
+        index = PmidIndex("metadata/.pmid_index.sqlite")
+        index.update(files)
+        index.lookup(pmids)
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.root_dir = os.path.dirname(self.path)
+        self.conn = sqlite3.connect(self.path, timeout=30)
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS pmids (
+                pmid INTEGER NOT NULL,
+                path TEXT NOT NULL,
+                PRIMARY KEY (pmid, path)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS pmids_path ON pmids (path);
+            """
+        )
+
+    def _relpath(self, file):
+        return os.path.relpath(os.path.abspath(file), self.root_dir)
+
+    def add(self, file, pmids):
+        """Replace the pmids of a metadata file, e.g. right after writing it."""
+        path = self._relpath(file)
+        stat = os.stat(file)
+        with self.conn:
+            self.conn.execute("DELETE FROM pmids WHERE path = ?", (path,))
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO pmids (pmid, path) VALUES (?, ?)",
+                [(int(pmid), path) for pmid in pmids if str(pmid).isdigit()],
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO files (path, size, mtime) VALUES (?, ?, ?)",
+                (path, stat.st_size, stat.st_mtime_ns),
+            )
+
+    def remove(self, file):
+        path = self._relpath(file)
+        with self.conn:
+            self.conn.execute("DELETE FROM pmids WHERE path = ?", (path,))
+            self.conn.execute("DELETE FROM files WHERE path = ?", (path,))
+
+    def update(self, files):
+        """Index the new or changed files and forget the deleted ones."""
+        indexed = {
+            path: (size, mtime)
+            for path, size, mtime in self.conn.execute(
+                "SELECT path, size, mtime FROM files"
+            )
+        }
+
+        for file in files:
+            path = self._relpath(file)
+            stat = os.stat(file)
+            if indexed.get(path) == (stat.st_size, stat.st_mtime_ns):
+                continue
+
+            try:
+                with open(file, "r") as f:
+                    if file.endswith(".ndjson"):
+                        articles = [json.loads(line) for line in f if line.strip()]
+                    else:
+                        articles = json.load(f)
+            except Exception as e:
+                logger.error("Load %s error, reason: %s" % (file, e))
+                continue
+
+            if type(articles) != list:
+                articles = []
+
+            pmids = [
+                article.get("pmid") for article in articles if type(article) == dict
+            ]
+            logger.info("Index %s pmids in %s" % (len(pmids), file))
+            self.add(file, pmids)
+
+        for path in indexed:
+            if not os.path.exists(os.path.join(self.root_dir, path)):
+                self.remove(os.path.join(self.root_dir, path))
+
+    def lookup(self, pmids):
+        """Find the indexed pmids.
+
+        Returns:
+            dict: pmid (str) -> the absolute path of the first metadata file
+                which contains it.
+        """
+        found = {}
+        pmids = [int(pmid) for pmid in pmids]
+        # Keep the number of sqlite variables in one query below the limit.
+        for i in range(0, len(pmids), 500):
+            chunk = pmids[i : i + 500]
+            rows = self.conn.execute(
+                "SELECT pmid, path FROM pmids WHERE pmid IN (%s) ORDER BY path"
+                % ",".join("?" * len(chunk)),
+                chunk,
+            )
+            for pmid, path in rows:
+                found.setdefault(str(pmid), os.path.join(self.root_dir, path))
+        return found
+
+    def close(self):
+        self.conn.close()
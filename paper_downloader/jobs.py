@@ -0,0 +1,347 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import logging
+import threading
+import traceback
+
+logger = logging.getLogger("paper-downloader")
+
+JOBS_FILE = ".jobs.sqlite"
+# A running job is given back to the queue when its worker doesn't renew the
+# lease in time, e.g. the monitor was killed.
+LEASE_SECONDS = 5 * 60
+MAX_ATTEMPTS = 3
+# A failed job is retried after 1 minute, then 2, 4... minutes.
+RETRY_BASE_SECONDS = 60
+POLL_SECONDS = 1
+
+
+class JobQueue(object):
+    """A durable job queue saved in an sqlite file.
+
+    A job is leased by a worker for lease_seconds, the worker renews the lease
+    while the job is running and marks it done or failed at the end. The jobs
+    which are pending or whose lease expired survive a restart and are picked
+    up again. A failed job is retried with exponential backoff until it has
+    been tried max_attempts times.
+
+    A job can have a key, only one pending job with the same key is kept, e.g.
+    several new pdfs of a project need only one pdf2html run.
+
+    Steps:
+        queue = JobQueue("/data/paper-downloader/.jobs.sqlite")
+        queue.enqueue("download", {"metadata_file": "..."})
+        job = queue.lease("worker-1")
+        ... run it ...
+        queue.complete(job["id"], "worker-1")
+        # or queue.fail(job["id"], "worker-1", "reason")
+    """
+
+    def __init__(
+        self,
+        path,
+        lease_seconds=LEASE_SECONDS,
+        retry_base_seconds=RETRY_BASE_SECONDS,
+    ):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.retry_base_seconds = retry_base_seconds
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                key TEXT,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                max_attempts INTEGER NOT NULL,
+                available_at REAL NOT NULL,
+                lease_until REAL,
+                worker TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, available_at);
+            CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key, status);
+            """
+        )
+
+    @staticmethod
+    def _to_dict(row):
+        job = dict(
+            zip(["id", "kind", "payload", "key", "status", "attempts", "worker"], row)
+        )
+        job["payload"] = json.loads(job["payload"])
+        return job
+
+    def enqueue(self, kind, payload, key=None, max_attempts=MAX_ATTEMPTS, delay=0):
+        """Add a job, return its id.
+
+        If a pending job has the same key, it is kept and its id is returned.
+        """
+        now = time.time()
+        with self.lock, self.conn:
+            if key is not None:
+                row = self.conn.execute(
+                    "SELECT id FROM jobs WHERE key = ? AND status = 'pending'", (key,)
+                ).fetchone()
+                if row:
+                    return row[0]
+
+            cursor = self.conn.execute(
+                "INSERT INTO jobs (kind, payload, key, status, max_attempts, "
+                "available_at, created_at, updated_at) "
+                "VALUES (?, ?, ?, 'pending', ?, ?, ?, ?)",
+                (kind, json.dumps(payload), key, max_attempts, now + delay, now, now),
+            )
+            return cursor.lastrowid
+
+    def lease(self, worker, on_failed=None):
+        """Take the next job which is ready to run, None if there is none.
+
+        A job whose lease expired is run again only if it has attempts left,
+        otherwise it is marked failed and on_failed(job, error) is called,
+        e.g. it killed the monitor every time.
+        """
+        now = time.time()
+        with self.lock, self.conn:
+            expired = [
+                self._to_dict(row)
+                for row in self.conn.execute(
+                    "SELECT id, kind, payload, key, status, attempts, worker FROM jobs "
+                    "WHERE status = 'running' AND lease_until < ? "
+                    "AND attempts >= max_attempts",
+                    (now,),
+                )
+            ]
+            for job in expired:
+                job["status"] = "failed"
+                job["error"] = "The lease expired after %s attempts." % job["attempts"]
+                self.conn.execute(
+                    "UPDATE jobs SET status = 'failed', lease_until = NULL, "
+                    "error = ?, updated_at = ? WHERE id = ?",
+                    (job["error"], now, job["id"]),
+                )
+
+            row = self.conn.execute(
+                "SELECT id, kind, payload, key, status, attempts, worker FROM jobs "
+                "WHERE (status = 'pending' AND available_at <= ?) "
+                "OR (status = 'running' AND lease_until < ? "
+                "AND attempts < max_attempts) "
+                "ORDER BY available_at, id LIMIT 1",
+                (now, now),
+            ).fetchone()
+            job = None
+            if row is not None:
+                job = self._to_dict(row)
+                if job["status"] == "running":
+                    logger.warning(
+                        "The lease of job %s (%s) held by %s expired, run it again."
+                        % (job["id"], job["kind"], job["worker"])
+                    )
+                job["attempts"] += 1
+                job["status"] = "running"
+                job["worker"] = worker
+                self.conn.execute(
+                    "UPDATE jobs SET status = 'running', attempts = ?, worker = ?, "
+                    "lease_until = ?, updated_at = ? WHERE id = ?",
+                    (job["attempts"], worker, now + self.lease_seconds, now, job["id"]),
+                )
+
+        for expired_job in expired:
+            logger.error(
+                "The lease of job %s (%s) held by %s expired, %s attempts used, "
+                "give up."
+                % (
+                    expired_job["id"],
+                    expired_job["kind"],
+                    expired_job["worker"],
+                    expired_job["attempts"],
+                )
+            )
+            if on_failed:
+                on_failed(expired_job, Exception(expired_job["error"]))
+        return job
+
+    def renew(self, job_id, worker):
+        """Extend the lease of a running job, return False if it was lost."""
+        now = time.time()
+        with self.lock, self.conn:
+            cursor = self.conn.execute(
+                "UPDATE jobs SET lease_until = ?, updated_at = ? "
+                "WHERE id = ? AND status = 'running' AND worker = ?",
+                (now + self.lease_seconds, now, job_id, worker),
+            )
+            return cursor.rowcount == 1
+
+    def complete(self, job_id, worker):
+        """Mark a running job done, return False if the lease was lost."""
+        now = time.time()
+        with self.lock, self.conn:
+            cursor = self.conn.execute(
+                "UPDATE jobs SET status = 'done', lease_until = NULL, error = NULL, "
+                "updated_at = ? WHERE id = ? AND status = 'running' AND worker = ?",
+                (now, job_id, worker),
+            )
+            return cursor.rowcount == 1
+
+    def fail(self, job_id, worker, error):
+        """Put a failed job back with backoff, or mark it failed when it has
+        no attempts left.
+
+        Returns:
+            bool: True if the job will be retried, None if the lease was lost
+            and the job is left to the worker which holds it now.
+        """
+        now = time.time()
+        with self.lock, self.conn:
+            row = self.conn.execute(
+                "SELECT attempts, max_attempts FROM jobs "
+                "WHERE id = ? AND status = 'running' AND worker = ?",
+                (job_id, worker),
+            ).fetchone()
+            if row is None:
+                return None
+
+            attempts, max_attempts = row
+            retry = attempts < max_attempts
+            self.conn.execute(
+                "UPDATE jobs SET status = ?, available_at = ?, lease_until = NULL, "
+                "error = ?, updated_at = ? "
+                "WHERE id = ? AND status = 'running' AND worker = ?",
+                (
+                    "pending" if retry else "failed",
+                    now + self.retry_base_seconds * 2 ** (attempts - 1),
+                    error,
+                    now,
+                    job_id,
+                    worker,
+                ),
+            )
+        return retry
+
+    def counts(self):
+        """The number of jobs of every status."""
+        with self.lock:
+            return dict(
+                self.conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")
+            )
+
+    def close(self):
+        self.conn.close()
+
+
+class JobWorkers(object):
+    """A pool of threads draining a JobQueue.
+
+    handlers maps a job kind to a function which takes the payload of a job,
+    the job fails when the function raises an exception. on_failed(job, error)
+    is called when a job has no attempts left. The leases of the running jobs
+    are renewed in the background.
+
+    Steps:
+        workers = JobWorkers(queue, {"download": download}, workers=2)
+        workers.start()
+        ...
+        workers.stop()
+    """
+
+    def __init__(
+        self, queue, handlers, workers=2, on_failed=None, poll_seconds=POLL_SECONDS
+    ):
+        self.queue = queue
+        self.handlers = handlers
+        self.on_failed = on_failed
+        self.workers = workers
+        self.poll_seconds = poll_seconds
+        self.stopped = threading.Event()
+        self.threads = []
+        self.running = {}
+        self.lock = threading.Lock()
+
+    def _give_up(self, job, error):
+        if self.on_failed:
+            try:
+                self.on_failed(job, error)
+            except Exception as err:
+                logger.error("on_failed of job %s failed: %s" % (job["id"], err))
+
+    def _run(self, worker):
+        while not self.stopped.is_set():
+            job = self.queue.lease(worker, on_failed=self._give_up)
+            if job is None:
+                self.stopped.wait(self.poll_seconds)
+                continue
+
+            with self.lock:
+                self.running[job["id"]] = worker
+            logger.info(
+                "%s runs job %s (%s), attempt %s."
+                % (worker, job["id"], job["kind"], job["attempts"])
+            )
+            try:
+                handler = self.handlers.get(job["kind"])
+                if handler is None:
+                    raise Exception("No handler for the %s jobs." % job["kind"])
+                handler(job["payload"])
+            except Exception as e:
+                logger.error(
+                    "Job %s (%s) failed: %s\n%s"
+                    % (job["id"], job["kind"], e, traceback.format_exc())
+                )
+                retry = self.queue.fail(job["id"], worker, str(e))
+                if retry is None:
+                    logger.warning(
+                        "%s lost the lease of job %s, its failure is not saved."
+                        % (worker, job["id"])
+                    )
+                elif not retry:
+                    logger.error(
+                        "Job %s (%s) failed %s times, give up."
+                        % (job["id"], job["kind"], job["attempts"])
+                    )
+                    self._give_up(job, e)
+            else:
+                if not self.queue.complete(job["id"], worker):
+                    logger.warning(
+                        "%s lost the lease of job %s, it is not marked done."
+                        % (worker, job["id"])
+                    )
+            finally:
+                with self.lock:
+                    self.running.pop(job["id"], None)
+
+    def _renew(self):
+        while not self.stopped.wait(self.queue.lease_seconds / 3):
+            with self.lock:
+                running = list(self.running.items())
+            for job_id, worker in running:
+                if not self.queue.renew(job_id, worker):
+                    logger.warning("%s lost the lease of job %s." % (worker, job_id))
+
+    def start(self):
+        prefix = "%s-%s" % (socket.gethostname(), os.getpid())
+        for i in range(self.workers):
+            thread = threading.Thread(
+                target=self._run, args=("%s-%s" % (prefix, i),), daemon=True
+            )
+            thread.start()
+            self.threads.append(thread)
+
+        thread = threading.Thread(target=self._renew, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def stop(self, wait=True):
+        """Stop taking new jobs, the running jobs are finished if wait is True."""
+        self.stopped.set()
+        if wait:
+            for thread in self.threads:
+                thread.join()
@@ -0,0 +1,233 @@
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+logger = logging.getLogger("paper-downloader")
+
+# The upper bounds (in seconds) of the buckets of the latency histograms.
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, float("inf")]
+
+_context = threading.local()
+
+
+class Histogram(object):
+    """A histogram with fixed buckets, the quantiles are estimated from it."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Interpolate the q quantile inside its bucket, None if it is empty."""
+        if not self.count:
+            return None
+
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = min(self.buckets[i], self.max)
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "max": self.max,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "buckets": {
+                str(bound): count for bound, count in zip(self.buckets, self.counts)
+            },
+        }
+
+
+class Stats(object):
+    """The aggregated requests of one source and host."""
+
+    def __init__(self):
+        self.outcomes = {}
+        self.bytes = 0
+        self.retries = 0
+        self.ttfb = Histogram()
+        self.total = Histogram()
+
+    def to_dict(self):
+        return {
+            "requests": sum(self.outcomes.values()),
+            "outcomes": self.outcomes,
+            "bytes": self.bytes,
+            "retries": self.retries,
+            "ttfb": self.ttfb.to_dict(),
+            "total": self.total.to_dict(),
+        }
+
+
+class DownloadMetrics(object):
+    """Collect the download requests of a run.
+
+    Every request is recorded with its source, host, bytes, time to first
+    byte, total time and outcome, a request is a retry when the same source
+    already requested the same path for the paper, e.g. on another mirror.
+    They are aggregated by source and host into histograms, so they can be
+    printed as a table at the end of the run or dumped as json.
+
+    Steps:
+        metrics = get_metrics()
+        with metrics.source("pmc"):
+            ... client.get and client.download_file record the requests ...
+        logger.info(metrics.summary())
+        metrics.dump("metrics.json")
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.started_at = time.time()
+
+    @contextmanager
+    def source(self, name):
+        """Label the requests sent by the current thread with a source name."""
+        previous = getattr(_context, "source", None)
+        _context.source = {"name": name, "paths": set()}
+        try:
+            yield
+        finally:
+            _context.source = previous
+
+    def record(self, url, outcome, size=0, ttfb=None, total=None, source=None):
+        parsed = urlparse(url)
+        context = getattr(_context, "source", None)
+        retries = 0
+        if context is not None:
+            path = (parsed.path, parsed.query)
+            retries = 1 if path in context["paths"] else 0
+            context["paths"].add(path)
+            source = source or context["name"]
+
+        key = (source or "unknown", parsed.netloc)
+        with self.lock:
+            stats = self.stats.setdefault(key, Stats())
+            stats.outcomes[outcome] = stats.outcomes.get(outcome, 0) + 1
+            stats.bytes += size
+            stats.retries += retries
+            if ttfb is not None:
+                stats.ttfb.observe(ttfb)
+            if total is not None:
+                stats.total.observe(total)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "started_at": self.started_at,
+                "elapsed": time.time() - self.started_at,
+                "sources": [
+                    dict(source=source, host=host, **stats.to_dict())
+                    for (source, host), stats in sorted(self.stats.items())
+                ],
+            }
+
+    def summary(self):
+        """Format the metrics as a table, one row per source and host."""
+        data = self.to_dict()
+        header = [
+            "source",
+            "host",
+            "requests",
+            "ok",
+            "failed",
+            "retries",
+            "MB",
+            "MB/s",
+            "ttfb p50",
+            "ttfb p95",
+            "total p50",
+            "total p95",
+            "total max",
+            "failures",
+        ]
+
+        def seconds(value):
+            return "-" if value is None else "%.2f" % value
+
+        rows = []
+        for row in data["sources"]:
+            ok = row["outcomes"].get("ok", 0)
+            total = row["total"]
+            rows.append(
+                [
+                    row["source"],
+                    row["host"],
+                    str(row["requests"]),
+                    str(ok),
+                    str(row["requests"] - ok),
+                    str(row["retries"]),
+                    "%.1f" % (row["bytes"] / 1024 / 1024),
+                    "%.2f" % (row["bytes"] / 1024 / 1024 / total["sum"])
+                    if total["sum"]
+                    else "-",
+                    seconds(row["ttfb"]["p50"]),
+                    seconds(row["ttfb"]["p95"]),
+                    seconds(total["p50"]),
+                    seconds(total["p95"]),
+                    seconds(total["max"] if total["count"] else None),
+                    ", ".join(
+                        "%s: %s" % (outcome, count)
+                        for outcome, count in sorted(row["outcomes"].items())
+                        if outcome != "ok"
+                    )
+                    or "-",
+                ]
+            )
+
+        widths = [
+            max(len(line[i]) for line in [header] + rows) for i in range(len(header))
+        ]
+        lines = [
+            "  ".join(cell.ljust(width) for cell, width in zip(line, widths)).rstrip()
+            for line in [header] + rows
+        ]
+        lines.insert(1, "  ".join("-" * width for width in widths))
+        return "\n".join(lines)
+
+    def dump(self, path):
+        dirname = os.path.dirname(os.path.abspath(path))
+        os.makedirs(dirname, exist_ok=True)
+        fd, tmp_file = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=dirname)
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+        os.replace(tmp_file, path)
+
+
+_metrics = DownloadMetrics()
+
+
+def get_metrics():
+    return _metrics
+
+
+def reset_metrics():
+    """Start a new DownloadMetrics, e.g. at the beginning of a run."""
+    global _metrics
+    _metrics = DownloadMetrics()
+    return _metrics
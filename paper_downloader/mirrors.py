@@ -0,0 +1,151 @@
+import time
+import logging
+import threading
+
+logger = logging.getLogger("paper-downloader")
+
+# A mirror is skipped after this many failures in a row.
+FAILURE_THRESHOLD = 3
+# Seconds before a skipped mirror gets a probe request, it is doubled after
+# every failed probe.
+OPEN_SECONDS = 60
+MAX_OPEN_SECONDS = 30 * 60
+# The weight of the newest sample in the latency/success averages.
+ALPHA = 0.3
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class NoMirrorAvailable(Exception):
+    pass
+
+
+class Mirror(object):
+    def __init__(self, url):
+        self.url = url
+        self.latency = None
+        self.success_rate = 1.0
+        self.failures = 0
+        self.state = CLOSED
+        self.open_seconds = OPEN_SECONDS
+        self.open_until = 0.0
+        # When the probe request was sent, 0 if there is no probe.
+        self.probe_started_at = 0.0
+
+    @property
+    def score(self):
+        # Lower is better, the mirrors which were never used are tried first.
+        return (self.latency or 0.0) / max(self.success_rate, 0.01)
+
+    def __repr__(self):
+        return "<Mirror %s %s latency=%s success_rate=%.2f>" % (
+            self.url,
+            self.state,
+            None if self.latency is None else round(self.latency, 3),
+            self.success_rate,
+        )
+
+
+class MirrorPool(object):
+    """A thread-safe pool of mirrors with a circuit breaker for every mirror.
+
+    Every request goes to the healthy mirror with the best score, i.e. the
+    lowest average latency divided by the success rate. A mirror is skipped
+    (open) after FAILURE_THRESHOLD failures in a row, when the open period is
+    over one probe request is sent to it (half-open) and it is used again if
+    the probe succeeds.
+
+    Steps:
+        pool = MirrorPool(["https://sci-hub.se", "https://sci-hub.ru"])
+        mirror = pool.choose()
+        pool.report(mirror, True, latency=0.8)
+    """
+
+    def __init__(self, urls):
+        self.mirrors = {url: Mirror(url) for url in urls}
+        self.lock = threading.Lock()
+
+    def add(self, urls):
+        with self.lock:
+            for url in urls:
+                self.mirrors.setdefault(url, Mirror(url))
+
+    def choose(self):
+        """Get the url of the best mirror, raise NoMirrorAvailable if all are open."""
+        now = time.monotonic()
+        with self.lock:
+            # Send one probe request to a skipped mirror when its open period
+            # is over.
+            for mirror in sorted(self.mirrors.values(), key=lambda m: m.open_until):
+                if mirror.state == OPEN and mirror.open_until <= now:
+                    mirror.state = HALF_OPEN
+                # A probe which is never reported times out after OPEN_SECONDS.
+                if (
+                    mirror.state == HALF_OPEN
+                    and now - mirror.probe_started_at > OPEN_SECONDS
+                ):
+                    mirror.probe_started_at = now
+                    logger.info("Probe the sci-hub mirror %s." % mirror.url)
+                    return mirror.url
+
+            closed = [m for m in self.mirrors.values() if m.state == CLOSED]
+            if closed:
+                return min(closed, key=lambda m: m.score).url
+
+        raise NoMirrorAvailable("Ran out of valid sci-hub urls")
+
+    def report(self, url, ok, latency=None):
+        """Record the outcome of a request sent to a mirror."""
+        with self.lock:
+            mirror = self.mirrors.get(url.rstrip("/"))
+            if mirror is None:
+                return
+
+            mirror.probe_started_at = 0.0
+            mirror.success_rate = (1 - ALPHA) * mirror.success_rate + ALPHA * ok
+            if ok:
+                if latency is not None:
+                    mirror.latency = (
+                        latency
+                        if mirror.latency is None
+                        else (1 - ALPHA) * mirror.latency + ALPHA * latency
+                    )
+                mirror.failures = 0
+                mirror.state = CLOSED
+                mirror.open_seconds = OPEN_SECONDS
+                return
+
+            mirror.failures += 1
+            if mirror.state == HALF_OPEN:
+                mirror.open_seconds = min(mirror.open_seconds * 2, MAX_OPEN_SECONDS)
+            elif mirror.failures < FAILURE_THRESHOLD:
+                return
+
+            mirror.state = OPEN
+            mirror.open_until = time.monotonic() + mirror.open_seconds
+            logger.warning(
+                "Skip the sci-hub mirror %s for %s seconds."
+                % (mirror.url, mirror.open_seconds)
+            )
+
+    def stats(self):
+        with self.lock:
+            return list(self.mirrors.values())
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_mirror_pool(name, urls):
+    """Get the process-wide mirror pool for `name`, create it if needed."""
+    with _pools_lock:
+        pool = _pools.get(name)
+        if pool is None:
+            pool = MirrorPool(urls)
+            _pools[name] = pool
+        else:
+            pool.add(urls)
+        return pool
@@ -1,6 +1,5 @@
 import os
 import click
-import requests
 import json
 import yaml
 import signal
@@ -11,6 +10,9 @@ import time
 import tempfile
 import hashlib
 import logging
+import threading
+from paper_downloader import client
+from paper_downloader.jobs import JobQueue, JobWorkers, JOBS_FILE
 
 
 # log config
@@ -50,7 +52,7 @@ def send_notification(msg, access_token=None):
         "text": {"content": msg},
     }
 
-    r = requests.post(url, headers=headers, data=json.dumps(data))
+    r = client.post(url, headers=headers, data=json.dumps(data))
     logger.info(r.text)
 
 
@@ -174,41 +176,65 @@ def handle_configfile_event(root_dir, filepath, access_token):
             )
             return None
 
-        with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as f:
-            temp_file = f.name
-            with open(temp_file, "w") as f:
-                json.dump(data, f, indent=4)
-                filepath = temp_file
-
-        download_pdf = data.get("download_pdf")
-
-        bin = get_bin("pfetcher")
-        cmd = f"{bin} fetch-metadata -d 3 -o {dest_file} -c {filepath} -l {logpath} -t {access_token}"
-
         if os.path.exists(dest_file):
             msg = f"{uniq_str}: 系统检测到在metadata目录已有同名的Metadata文件, 请重命名配置文件后重试。"
             send_notification(msg, access_token)
             return None
 
-        try:
-            send_notification(f"{uniq_str}: 解析配置文件成功", access_token)
-            subprocess.call(cmd, shell=True)
-            if download_pdf:
-                msg = f"{uniq_str}: 系统已获取到新的文献元数据。正在下载文献PDF，请稍后。"
-                send_notification(msg, access_token)
-                download_pdfs(root_dir, dest_file, access_token)
-
-            msg = f"{uniq_str}: 系统已处理完毕新的检索式。请前往publications.3steps.cn下载Metadata，并导入至Prophet Studio。"
-
-            send_notification(msg, access_token)
-        except Exception as e:
-            msg = f"{uniq_str}: 系统处理时出现了错误。请管理员前往Prophet Server查看错误信息。以下是错误信息：\n{e}"
-            send_notification(msg, access_token)
+        send_notification(f"{uniq_str}: 解析配置文件成功", access_token)
+        # The config is saved in the job, it is run by the job workers and
+        # survives a restart of the monitor.
+        get_job_queue(root_dir).enqueue(
+            "metadata",
+            {"config": data, "dest_file": dest_file, "logpath": logpath},
+            key="metadata:%s" % dest_file,
+        )
 
     else:
         logger.error("The file is not an expected config json file")
 
 
+def run_command(cmd):
+    """Run a pfetcher command, raise an exception if it fails."""
+    code = subprocess.call(cmd, shell=True)
+    if code != 0:
+        raise Exception(f"pfetcher {cmd.split()[1]} exited with code {code}.")
+
+
+def run_metadata_job(root_dir, payload, access_token):
+    dest_file = payload["dest_file"]
+    uniq_str = get_project_name(root_dir, dest_file)
+    checkpoint_file = dest_file + ".checkpoint"
+
+    # The metadata file exists without a checkpoint, the last run finished
+    # before the monitor was restarted.
+    if not os.path.exists(dest_file) or os.path.exists(checkpoint_file):
+        with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as f:
+            temp_file = f.name
+            with open(temp_file, "w") as f:
+                json.dump(payload["config"], f, indent=4)
+
+        bin = get_bin("pfetcher")
+        cmd = f"{bin} fetch-metadata -d 3 -w 4 -o {dest_file} -c {temp_file} -l {payload['logpath']}"
+        if os.path.exists(checkpoint_file):
+            cmd += " -r"
+        cmd += f" -t {access_token}"
+        try:
+            run_command(cmd)
+        finally:
+            os.remove(temp_file)
+
+    if payload["config"].get("download_pdf"):
+        msg = f"{uniq_str}: 系统已获取到新的文献元数据。正在下载文献PDF，请稍后。"
+        send_notification(msg, access_token)
+        get_job_queue(root_dir).enqueue(
+            "download", {"metadata_file": dest_file}, key="download:%s" % dest_file
+        )
+
+    msg = f"{uniq_str}: 系统已处理完毕新的检索式。请前往publications.3steps.cn下载Metadata，并导入至Prophet Studio。"
+    send_notification(msg, access_token)
+
+
 def download_pdfs(root_dir, metadata_json_file, access_token):
     if not os.path.isfile(metadata_json_file):
         logger.error("The metadata file is not an expected json file")
@@ -222,14 +248,9 @@ def download_pdfs(root_dir, metadata_json_file, access_token):
     pdf_dir = get_pdf_dir(root_dir, metadata_json_file)
     bin = get_bin("pfetcher")
     cmd = f"{bin} fetch-pdf -o {pdf_dir} -m {metadata_json_file} -l {logpath}"
-    try:
-        subprocess.call(cmd, shell=True)
-        msg = f"{project_name}: 系统已下载完所有文献PDF。请前往Prophet Studio查看。"
-        send_notification(msg, access_token)
-    except Exception as e:
-        msg = f"{project_name}: 系统处理时出现了错误。请管理员前往Prophet Server查看错误信息。以下是错误信息：\n{e}"
-        logger.error(msg)
-        send_notification(msg, access_token)
+    run_command(cmd)
+    msg = f"{project_name}: 系统已下载完所有文献PDF。请前往Prophet Studio查看。"
+    send_notification(msg, access_token)
 
 
 # Define a function to handle events
@@ -249,19 +270,77 @@ def handle_pdf_event(root_dir, filepath, access_token):
         msg = f"{uniq_str}: 系统已获取到新的文献PDF。正在转换为HTML，请稍后。"
         send_notification(msg, access_token)
 
-        bin = get_bin("pfetcher")
-        html_dir = get_html_dir(root_dir, filepath)
-        cmd = f"{bin} pdf2html -p {pdf_dir} -h {html_dir} -l {logpath}"
-        subprocess.call(cmd, shell=True)
-        if os.path.exists(
-            os.path.join(html_dir, os.path.basename(filepath).replace(".pdf", ".html"))
-        ):
-            msg = f"{uniq_str}: 系统已将所有文献PDF转换为HTML。请前往Prophet Studio查看。"
-            send_notification(msg, access_token)
+        # pdf2html converts all the pdfs of the project, so the new pdfs of a
+        # project share one pending job.
+        get_job_queue(root_dir).enqueue(
+            "convert",
+            {"pdf_file": filepath, "logpath": logpath},
+            key="convert:%s" % pdf_dir,
+        )
     else:
         logger.info("The file is not a expected pdf file")
 
 
+def run_convert_job(root_dir, payload, access_token):
+    filepath = payload["pdf_file"]
+    uniq_str = get_project_name(root_dir, filepath)
+    pdf_dir = get_pdf_dir(root_dir, filepath)
+    html_dir = get_html_dir(root_dir, filepath)
+
+    bin = get_bin("pfetcher")
+    cmd = f"{bin} pdf2html -p {pdf_dir} -h {html_dir} -l {payload['logpath']}"
+    run_command(cmd)
+    if os.path.exists(
+        os.path.join(html_dir, os.path.basename(filepath).replace(".pdf", ".html"))
+    ):
+        msg = f"{uniq_str}: 系统已将所有文献PDF转换为HTML。请前往Prophet Studio查看。"
+        send_notification(msg, access_token)
+
+
+_job_queues = {}
+_job_queues_lock = threading.Lock()
+
+
+def get_job_queue(root_dir):
+    """The job queue of a root directory, it is saved in root_dir/.jobs.sqlite."""
+    path = os.path.join(os.path.abspath(root_dir), JOBS_FILE)
+    with _job_queues_lock:
+        if path not in _job_queues:
+            _job_queues[path] = JobQueue(path)
+        return _job_queues[path]
+
+
+def start_job_workers(root_dir, access_token, workers):
+    """Start the workers which run the metadata, download and convert jobs.
+
+    The pending jobs of the last run are picked up again.
+    """
+    handlers = {
+        "metadata": lambda payload: run_metadata_job(root_dir, payload, access_token),
+        "download": lambda payload: download_pdfs(
+            root_dir, payload["metadata_file"], access_token
+        ),
+        "convert": lambda payload: run_convert_job(root_dir, payload, access_token),
+    }
+
+    def on_failed(job, error):
+        payload = job["payload"]
+        filepath = (
+            payload.get("dest_file")
+            or payload.get("metadata_file")
+            or payload.get("pdf_file")
+        )
+        project_name = get_project_name(root_dir, filepath)
+        msg = f"{project_name}: 系统处理时出现了错误。请管理员前往Prophet Server查看错误信息。以下是错误信息：\n{error}"
+        send_notification(msg, access_token)
+
+    queue = get_job_queue(root_dir)
+    logger.info("Jobs in %s: %s" % (queue.path, queue.counts()))
+    job_workers = JobWorkers(queue, handlers, workers=workers, on_failed=on_failed)
+    job_workers.start()
+    return job_workers
+
+
 def make_dirs(dir):
     if not os.path.exists(dir):
         raise Exception(f"Directory {dir} does not exist")
@@ -323,17 +402,14 @@ class FileEventHandler(RegexMatchingEventHandler):
             ignore_regexes=[r".*\.gitkeep", r".*\.minio.sys.*"],
         )
 
-    # def on_moved(self, event):
-    #     if event.is_directory:
-    #         logger.info(
-    #             "directory moved from {0} to {1}".format(
-    #                 event.src_path, event.dest_path
-    #             )
-    #         )
-    #     else:
-    #         logger.info(
-    #             "file moved from {0} to {1}".format(event.src_path, event.dest_path)
-    #         )
+    def on_moved(self, event):
+        # The pdfs are downloaded into a temporary file and renamed, so they
+        # come as moved events.
+        print("on_moved: {0} -> {1}".format(event.src_path, event.dest_path))
+        if ".minio.sys" in event.dest_path:
+            return
+
+        handle_create_event(self.root_dir, event.dest_path, self.token)
 
     def on_created(self, event):
         print("on_created: {0}, {1}".format(event.src_path, event.is_directory))
@@ -363,9 +439,16 @@ cli = click.Group()
 @click.option(
     "-t", "--token", default=".", help="The token to be used to send notification"
 )
-def watchdog(root_dir, token):
+@click.option(
+    "-w",
+    "--workers",
+    default=2,
+    help="How many jobs (fetching metadata, downloading and converting pdfs) run at the same time",
+)
+def watchdog(root_dir, token, workers):
     observer = Observer()
     root_dir = root_dir.rstrip("/")
+    job_workers = start_job_workers(root_dir, token, workers)
     event_handler = FileEventHandler(root_dir, token)
     observer.schedule(event_handler, root_dir, True)
     observer.start()
@@ -374,6 +457,7 @@ def watchdog(root_dir, token):
             time.sleep(1)
     except KeyboardInterrupt:
         observer.stop()
+        job_workers.stop(wait=False)
     observer.join()
 
 
@@ -460,10 +544,17 @@ def get_event_handler(root_dir, access_token):
     required=False,
     default=".",
 )
-def minio(access_key, secret_key, server, secure, access_token, root_dir="."):
+@click.option(
+    "-w",
+    "--workers",
+    help="How many jobs (fetching metadata, downloading and converting pdfs) run at the same time",
+    required=False,
+    default=2,
+)
+def minio(access_key, secret_key, server, secure, access_token, root_dir=".", workers=2):
     from minio import Minio
-    import threading
 
+    job_workers = start_job_workers(root_dir, access_token, workers)
     minio_client = Minio(
         server, access_key=access_key, secret_key=secret_key, secure=secure
     )
@@ -494,6 +585,7 @@ def minio(access_key, secret_key, server, secure, access_token, root_dir="."):
 
     # Response to a killing signal.
     def signal_handler(sig, frame):
+        job_workers.stop(wait=False)
         for thread in threads:
             thread.stop()
 
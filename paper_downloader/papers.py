@@ -0,0 +1,83 @@
+import os
+import json
+from datetime import datetime
+
+
+def write_json(data, filename):
+    with open(filename, "w") as f:
+        json.dump(data, f, indent=2)
+
+
+def read_json(filename):
+    if os.path.exists(filename):
+        if filename.endswith(".ndjson"):
+            return read_ndjson(filename)
+
+        with open(filename, "r") as f:
+            return json.load(f)
+    else:
+        return []
+
+
+def read_ndjson(filename):
+    records = []
+    with open(filename, "r") as f:
+        for line in f:
+            if line.strip():
+                records.append(json.loads(line))
+    return records
+
+
+def ndjson_to_json(ndjson_file, json_file):
+    """Materialize a NDJSON file as a json array, line by line.
+
+    The output is the same as write_json(records, json_file). It is written
+    into a temporary file first, so json_file is never half written.
+    """
+    tmp_file = json_file + ".tmp"
+    with open(ndjson_file, "r") as src, open(tmp_file, "w") as dest:
+        dest.write("[")
+        count = 0
+        for line in src:
+            if line.strip():
+                record = json.dumps(json.loads(line), indent=2)
+                dest.write(",\n  " if count else "\n  ")
+                dest.write(record.replace("\n", "\n  "))
+                count += 1
+        dest.write("\n]" if count else "]")
+    os.replace(tmp_file, json_file)
+
+
+def make_paper(pmid, article, author="Anonymous", get_impact_factor_fn=None):
+    """Make a metadata record from a metapub PubMedArticle."""
+    paper = {}
+    paper["tag"] = author
+    paper["pmid"] = int(pmid)
+    paper["pmcid"] = article.pmc if article.pmc else ""
+    paper["pmc_link"] = (
+        "https://www.ncbi.nlm.nih.gov/pmc/articles/" + article.pmc
+        if article.pmc
+        else ""
+    )
+    paper["pubmed_link"] = "https://pubmed.ncbi.nlm.nih.gov/" + pmid
+    paper["abstract"] = (
+        article.abstract.replace("\n", " ")
+        if article.abstract is not None
+        else ""
+    )
+    paper["title"] = article.title
+    paper["imported_date"] = datetime.now().strftime("%Y-%m-%d")
+    paper["authors"] = ", ".join(article.authors)
+    paper["journal_abbr"] = article.journal
+    paper["journal"] = "Unknown"
+    paper["pdf"] = ""
+    paper["html"] = ""
+    paper["impact_factor"] = -1
+    paper["publication"] = article.year
+    paper["doi"] = article.doi if article.doi else ""
+    paper["doi_link"] = "https://doi.org/" + paper["doi"]
+
+    if get_impact_factor_fn:
+        paper["impact_factor"], paper["journal"] = get_impact_factor_fn(article.journal)
+
+    return paper
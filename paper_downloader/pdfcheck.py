@@ -0,0 +1,104 @@
+import os
+import json
+import mmap
+import logging
+import tempfile
+import threading
+
+logger = logging.getLogger("paper-downloader")
+
+PDF_MANIFEST_FILE = ".pdf_manifest.json"
+# A pdf starts with %PDF- in its first 1024 bytes and ends with %%EOF in its
+# last 1024 bytes, anything smaller than 1 KB is an error page.
+PDF_HEADER = b"%PDF-"
+PDF_TRAILER = b"%%EOF"
+PDF_WINDOW = 1024
+MIN_PDF_SIZE = 1024
+
+
+def check_pdf(filename):
+    """Check whether a file looks like a complete pdf, without parsing it.
+
+    Only the first and the last 1024 bytes are read, the tail is read by mmap.
+
+    Returns:
+        tuple: (valid, reason)
+    """
+    try:
+        size = os.path.getsize(filename)
+        if size < MIN_PDF_SIZE:
+            return False, "too small (%s bytes)" % size
+
+        with open(filename, "rb") as f:
+            if PDF_HEADER not in f.read(PDF_WINDOW):
+                return False, "no %PDF- header, it may be an html page"
+
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                if m.rfind(PDF_TRAILER, max(size - PDF_WINDOW, 0)) == -1:
+                    return False, "no %%EOF trailer, it may be truncated"
+    except (OSError, ValueError) as e:
+        return False, str(e)
+
+    return True, None
+
+
+class PdfManifest(object):
+    """The results of check_pdf for the pdfs of a directory.
+
+    A pdf is only checked again when its size or mtime changes.
+
+    Steps:
+        manifest = PdfManifest("pdf/.pdf_manifest.json")
+        valid, reason = manifest.check("pdf/1.pdf")
+        manifest.save()
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.lock = threading.Lock()
+        self.changed = False
+        try:
+            with open(self.path, "r") as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def check(self, filename):
+        key = os.path.basename(filename)
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return False, "no such file"
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if (
+                entry
+                and entry["size"] == stat.st_size
+                and entry["mtime"] == stat.st_mtime_ns
+            ):
+                return entry["valid"], entry["reason"]
+
+        valid, reason = check_pdf(filename)
+        with self.lock:
+            self.entries[key] = {
+                "size": stat.st_size,
+                "mtime": stat.st_mtime_ns,
+                "valid": valid,
+                "reason": reason,
+            }
+            self.changed = True
+        return valid, reason
+
+    def save(self):
+        with self.lock:
+            if not self.changed:
+                return
+
+            fd, tmp_file = tempfile.mkstemp(
+                prefix=".", suffix=".tmp", dir=os.path.dirname(self.path)
+            )
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_file, self.path)
+            self.changed = False
@@ -0,0 +1,148 @@
+import time
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlparse
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+# NCBI E-utilities allow 3 requests per second without an API key
+# and 10 requests per second with one.
+# https://www.ncbi.nlm.nih.gov/books/NBK25497/
+NCBI_RATE = 3
+NCBI_RATE_WITH_API_KEY = 10
+# How many requests can be sent to one host at the same time.
+DEFAULT_HOST_CONCURRENCY = 2
+HOST_CONCURRENCY = {
+    "www.ncbi.nlm.nih.gov": 3,
+}
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+class TokenBucket(object):
+    """A thread-safe token bucket.
+
+    Each request takes one token and the tokens are refilled at `rate` per
+    second, up to `capacity`. All threads sharing a bucket are limited
+    together, so a pool of workers never goes above `rate` requests per second.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self.updated_at
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated_at = now
+
+    def acquire(self):
+        """Block until a token is available and take it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    self._refill(now)
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Stop handing out tokens for `seconds`, e.g. after a 429 response."""
+        with self.lock:
+            now = time.monotonic()
+            self.paused_until = max(self.paused_until, now + seconds)
+            self.tokens = 0
+            self.updated_at = max(self.updated_at, self.paused_until)
+
+
+class HostLimiter(object):
+    """Limit the concurrent requests to every host.
+
+    Steps:
+        limiter = HostLimiter(default=2, limits={"www.ncbi.nlm.nih.gov": 3})
+        with limiter.slot("https://www.ncbi.nlm.nih.gov/pmc/articles/PMC1/"):
+            ...
+    """
+
+    def __init__(self, default=DEFAULT_HOST_CONCURRENCY, limits=None):
+        self.default = default
+        self.limits = dict(HOST_CONCURRENCY, **(limits or {}))
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    def _get_semaphore(self, host):
+        with self.lock:
+            semaphore = self.semaphores.get(host)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(
+                    self.limits.get(host, self.default)
+                )
+                self.semaphores[host] = semaphore
+            return semaphore
+
+    @contextmanager
+    def slot(self, url):
+        """Wait for a free slot of the host of the url."""
+        semaphore = self._get_semaphore(urlparse(url).netloc.lower())
+        with semaphore:
+            yield
+
+
+_host_limiter = HostLimiter()
+
+
+def get_host_limiter():
+    return _host_limiter
+
+
+def set_host_limiter(default=DEFAULT_HOST_CONCURRENCY, limits=None):
+    """Replace the process-wide host limiter, e.g. with the --per-host option."""
+    global _host_limiter
+    _host_limiter = HostLimiter(default, limits)
+    return _host_limiter
+
+
+def get_limiter(name, rate, capacity=1):
+    """Get the process-wide token bucket for `name`, create it if needed."""
+    with _limiters_lock:
+        limiter = _limiters.get(name)
+        if limiter is None or limiter.rate != rate:
+            limiter = TokenBucket(rate, capacity)
+            _limiters[name] = limiter
+        return limiter
+
+
+def get_ncbi_limiter(api_key=None):
+    return get_limiter(
+        "ncbi", NCBI_RATE_WITH_API_KEY if api_key else NCBI_RATE
+    )
+
+
+def get_retry_after(response, default=1):
+    """Parse the Retry-After header (seconds or an HTTP date) of a response."""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return default
+
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+
+    try:
+        retry_at = parsedate_to_datetime(value)
+        if retry_at.tzinfo is None:
+            retry_at = retry_at.replace(tzinfo=timezone.utc)
+        return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0)
+    except (TypeError, ValueError):
+        return default
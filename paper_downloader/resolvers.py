@@ -0,0 +1,420 @@
+import os
+import abc
+import json
+import logging
+import tempfile
+import threading
+from urllib.parse import urljoin
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from bs4 import BeautifulSoup
+
+from paper_downloader import client
+from paper_downloader.cache import DEFAULT_CACHE_DIR
+from paper_downloader.sources import SciHub, download_pmc, headers
+from paper_downloader.metrics import get_metrics
+from paper_downloader.pdfcheck import check_pdf
+from paper_downloader.ratelimit import get_host_limiter
+
+logger = logging.getLogger("paper-downloader")
+
+# Start the next source when the current ones have not found the pdf after
+# this many seconds.
+DEFAULT_HEDGE_DELAY = 10
+DEFAULT_SOURCES = ["pmc", "europepmc", "unpaywall", "doi", "scihub"]
+# The wins of the sources are saved in the cache dir.
+SOURCE_STATS_FILE = "sources.json"
+
+
+def _is_pdf(res):
+    return res.status_code in [200, 206] and "pdf" in res.headers.get(
+        "Content-Type", ""
+    )
+
+
+def download_pdf_url(url, filepath, cancelled=None, session=None):
+    """Download a pdf url, return False if the response is not a pdf."""
+    with get_host_limiter().slot(url):
+        info = client.download_file(
+            url,
+            filepath,
+            session,
+            check_response=_is_pdf,
+            cancelled=cancelled,
+            headers=headers,
+        )
+    return info is not None
+
+
+def get_json(url, params=None):
+    with get_host_limiter().slot(url):
+        res = client.get(url, params=params, headers=headers)
+    if res.status_code != 200:
+        return None
+    return res.json()
+
+
+class Source(abc.ABC):
+    """A source of full text pdfs.
+
+    A source downloads the pdf of an article into a file, it returns False if
+    it doesn't have the pdf. Add a new source by subclassing it, implementing
+    fetch and adding it to SOURCES.
+    """
+
+    name = None
+
+    def applies(self, article):
+        return True
+
+    @abc.abstractmethod
+    def fetch(self, article, filepath, cancelled=None):
+        """Download the pdf of the article into filepath, return True if found."""
+
+
+class PMCSource(Source):
+    name = "pmc"
+
+    def __init__(self, cache=None):
+        self.cache = cache
+
+    def applies(self, article):
+        return bool(article.get("pmcid"))
+
+    def fetch(self, article, filepath, cancelled=None):
+        return download_pmc(
+            article["pmcid"], filepath, cache=self.cache, cancelled=cancelled
+        )
+
+
+class EuropePMCSource(Source):
+    """The open access pdfs rendered by Europe PMC."""
+
+    name = "europepmc"
+    render_url = "https://europepmc.org/backend/ptpmcrender.fcgi"
+    search_url = "https://www.ebi.ac.uk/europepmc/webservices/rest/search"
+
+    def applies(self, article):
+        return bool(article.get("pmcid") or article.get("pmid"))
+
+    def _find_pmcid(self, pmid):
+        data = get_json(
+            self.search_url,
+            params={
+                "query": "EXT_ID:%s AND SRC:MED" % pmid,
+                "resultType": "lite",
+                "format": "json",
+            },
+        )
+        for result in ((data or {}).get("resultList") or {}).get("result", []):
+            if result.get("pmcid") and result.get("isOpenAccess") == "Y":
+                return result["pmcid"]
+        return None
+
+    def fetch(self, article, filepath, cancelled=None):
+        pmcid = article.get("pmcid") or self._find_pmcid(article.get("pmid"))
+        if not pmcid:
+            return False
+
+        url = "%s?accid=%s&blobtype=pdf" % (self.render_url, pmcid)
+        return download_pdf_url(url, filepath, cancelled)
+
+
+class UnpaywallSource(Source):
+    """The open access copies found by Unpaywall, it needs an email."""
+
+    name = "unpaywall"
+    api_url = "https://api.unpaywall.org/v2/"
+
+    def __init__(self, email=None):
+        self.email = email
+
+    def applies(self, article):
+        return bool(self.email and article.get("doi"))
+
+    def fetch(self, article, filepath, cancelled=None):
+        data = get_json(self.api_url + article["doi"], params={"email": self.email})
+        if not data:
+            return False
+
+        locations = [data.get("best_oa_location")] + (data.get("oa_locations") or [])
+        urls = []
+        for location in locations:
+            url = (location or {}).get("url_for_pdf")
+            if url and url not in urls:
+                urls.append(url)
+
+        for url in urls:
+            if cancelled is not None and cancelled.is_set():
+                return False
+            try:
+                if download_pdf_url(url, filepath, cancelled):
+                    return True
+            except client.DownloadCancelled:
+                raise
+            except Exception as e:
+                logger.info("Cannot download %s, reason: %s" % (url, e))
+        return False
+
+
+class DOISource(Source):
+    """The publisher landing page of the doi, the pdf link is found by the
+    citation_pdf_url meta tag."""
+
+    name = "doi"
+    doi_url = "https://doi.org/"
+
+    def applies(self, article):
+        return bool(article.get("doi"))
+
+    def fetch(self, article, filepath, cancelled=None):
+        url = self.doi_url + article["doi"]
+        with get_host_limiter().slot(url), client.get(
+            url, headers=headers, stream=True
+        ) as res:
+            if res.status_code != 200:
+                return False
+
+            if _is_pdf(res):
+                # The doi is redirected to the pdf itself.
+                pdf_url = res.url
+            else:
+                soup = BeautifulSoup(res.content, "html.parser")
+                meta = soup.find("meta", attrs={"name": "citation_pdf_url"})
+                pdf_url = meta.get("content") if meta else None
+                if pdf_url:
+                    pdf_url = urljoin(res.url, pdf_url)
+
+        if not pdf_url:
+            return False
+        return download_pdf_url(pdf_url, filepath, cancelled)
+
+
+class SciHubSource(Source):
+    name = "scihub"
+
+    def applies(self, article):
+        return bool(article.get("doi"))
+
+    def fetch(self, article, filepath, cancelled=None):
+        return SciHub().download(
+            article["doi"],
+            destination=os.path.dirname(filepath),
+            path=os.path.basename(filepath),
+            cancelled=cancelled,
+        )
+
+
+SOURCES = {
+    "pmc": PMCSource,
+    "europepmc": EuropePMCSource,
+    "unpaywall": UnpaywallSource,
+    "doi": DOISource,
+    "scihub": SciHubSource,
+}
+
+
+def get_publisher(article):
+    """The doi prefix (e.g. 10.1016) identifies the publisher."""
+    doi = article.get("doi")
+    if doi and "/" in doi:
+        return doi.split("/")[0]
+    return article.get("journal_abbr") or "unknown"
+
+
+class SourceStats(object):
+    """Remember which source wins for every publisher.
+
+    It is saved as a json file, {publisher: {source: wins}}.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(self.path, "r") as f:
+                self.wins = json.load(f)
+        except (OSError, ValueError):
+            self.wins = {}
+
+    def order(self, publisher, sources):
+        wins = self.wins.get(publisher, {})
+        # sorted is stable, the sources without wins keep the default order.
+        return sorted(sources, key=lambda source: -wins.get(source.name, 0))
+
+    def record(self, publisher, source):
+        with self.lock:
+            wins = self.wins.setdefault(publisher, {})
+            wins[source] = wins.get(source, 0) + 1
+
+    def save(self):
+        with self.lock:
+            dirname = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(dirname, exist_ok=True)
+            fd, tmp_file = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=dirname)
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.wins, f)
+            os.replace(tmp_file, self.path)
+
+
+class PdfResolver(object):
+    """Find the pdf of an article from several sources.
+
+    The sources are tried in the order which wins most often for the
+    publisher of the article. The first one starts at once, and the next one
+    is started when the running ones fail or are still running after
+    hedge_delay seconds. The first valid pdf wins and the others are
+    cancelled.
+
+    The wins of the sources are saved in <cache_dir>/sources.json, or in
+    stats_file if it is set, they are not saved if stats_file is False.
+
+    Steps:
+        resolver = PdfResolver(["pmc", "doi", "scihub"], cache=cache)
+        resolver.resolve(article, "pdf/1.pdf")
+        resolver.close()
+    """
+
+    def __init__(
+        self,
+        sources=DEFAULT_SOURCES,
+        cache=None,
+        email=None,
+        hedge_delay=DEFAULT_HEDGE_DELAY,
+        cache_dir=None,
+        stats_file=None,
+    ):
+        self.sources = []
+        for name in sources:
+            # A Source instance can be used as it is, e.g. in the tests.
+            if isinstance(name, Source):
+                self.sources.append(name)
+            elif name not in SOURCES:
+                raise Exception(
+                    "Unknown source %s, it should be one of %s."
+                    % (name, ", ".join(SOURCES))
+                )
+            elif name == "pmc":
+                self.sources.append(PMCSource(cache))
+            elif name == "unpaywall":
+                self.sources.append(UnpaywallSource(email))
+            else:
+                self.sources.append(SOURCES[name]())
+        self.hedge_delay = hedge_delay
+        if stats_file is None:
+            stats_file = os.path.join(
+                os.path.expanduser(cache_dir or DEFAULT_CACHE_DIR), SOURCE_STATS_FILE
+            )
+        self.stats = SourceStats(stats_file) if stats_file else None
+        self.lock = threading.Lock()
+
+    def get_sources(self, article):
+        """The names of the sources which may have the pdf of the article."""
+        return [source.name for source in self.sources if source.applies(article)]
+
+    @staticmethod
+    def _remove_partial_files(tmp_file):
+        for filename in [tmp_file, tmp_file + ".part", tmp_file + ".part.json"]:
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+
+    def _fetch(self, source, article, filepath, cancelled):
+        """Download the pdf from a source, return True if it wins."""
+        tmp_file = "%s.%s" % (filepath, source.name)
+        try:
+            with get_metrics().source(source.name):
+                fetched = source.fetch(article, tmp_file, cancelled)
+            if fetched and os.path.exists(tmp_file):
+                valid, reason = check_pdf(tmp_file)
+                if valid:
+                    with self.lock:
+                        if not cancelled.is_set():
+                            cancelled.set()
+                            os.replace(tmp_file, filepath)
+                            return True
+                else:
+                    logger.info(
+                        "The pdf from %s is invalid (%s), skip it."
+                        % (source.name, reason)
+                    )
+        except client.DownloadCancelled:
+            pass
+        except Exception as e:
+            logger.warning(
+                "Download %s from %s failed, reason: %s"
+                % (article.get("pmid"), source.name, e)
+            )
+
+        # Keep the partial download for the next run, unless another source wins.
+        if cancelled.is_set():
+            self._remove_partial_files(tmp_file)
+        elif os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        return False
+
+    def resolve(self, article, filepath):
+        """Download the pdf of an article into filepath.
+
+        Returns:
+            str: the name of the winning source, None if no source has the pdf.
+        """
+        publisher = get_publisher(article)
+        sources = [source for source in self.sources if source.applies(article)]
+        if self.stats:
+            sources = self.stats.order(publisher, sources)
+        if not sources:
+            return None
+
+        cancelled = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=len(sources))
+        running = {}
+        tried = []
+        winner = None
+        try:
+            while (sources or running) and winner is None:
+                if sources:
+                    source = sources.pop(0)
+                    logger.info(
+                        "Try to download %s from %s."
+                        % (article.get("pmid"), source.name)
+                    )
+                    future = executor.submit(
+                        self._fetch, source, article, filepath, cancelled
+                    )
+                    running[future] = source
+                    tried.append(source.name)
+
+                # Wait for the running sources, start the next one if they
+                # fail or are too slow.
+                while running and winner is None:
+                    done, _ = wait(
+                        running,
+                        timeout=self.hedge_delay if sources else None,
+                        return_when=FIRST_COMPLETED,
+                    )
+                    if not done:
+                        break
+                    for future in done:
+                        source = running.pop(future)
+                        if future.result():
+                            winner = source.name
+                    if sources:
+                        break
+        finally:
+            cancelled.set()
+            executor.shutdown(wait=False)
+
+        if winner:
+            # The sources which failed before the winner keep their partial
+            # downloads for the next run, they are not needed any more.
+            for name in tried:
+                self._remove_partial_files("%s.%s" % (filepath, name))
+            if self.stats:
+                self.stats.record(publisher, winner)
+        return winner
+
+    def close(self):
+        if self.stats:
+            self.stats.save()
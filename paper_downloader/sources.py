@@ -0,0 +1,404 @@
+import os
+import re
+import time
+import hashlib
+import logging
+
+import requests
+from bs4 import BeautifulSoup
+from retrying import retry
+
+from paper_downloader import client
+from paper_downloader.mirrors import get_mirror_pool, NoMirrorAvailable
+from paper_downloader.ratelimit import get_host_limiter
+
+logger = logging.getLogger("paper-downloader")
+
+SCHOLARS_BASE_URL = "https://scholar.google.com/scholar"
+PMC_BASE_URL = "https://www.ncbi.nlm.nih.gov"
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (X11; Linux x86_64; rv:27.0) Gecko/20100101 Firefox/27.0"
+}
+
+headers = {
+    "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.114 Safari/537.36"
+}
+
+
+class CaptchaNeedException(Exception):
+    pass
+
+
+class SciHub(object):
+    """
+    SciHub class can search for papers on Google Scholars
+    and fetch/download papers from sci-hub.io
+
+    The mirrors are shared by all SciHub instances of the process, every
+    request goes to the fastest healthy mirror.
+    """
+
+    def __init__(self):
+        self.sess = client.make_session()
+        self.sess.headers = HEADERS  # type: ignore
+        self.mirrors = get_mirror_pool("scihub", self._get_available_scihub_urls())
+        # It is set to the best mirror before every request.
+        self.base_url = None
+
+    def _get_available_scihub_urls(self):
+        """
+        Finds available scihub urls via https://sci-hub.now.sh/
+        """
+        return ["https://sci-hub.ee", "https://sci-hub.ru", "https://sci-hub.se"]
+        urls = []
+        res = client.get("https://sci-hub.now.sh/")
+        s = self._get_soup(res.content)
+        for a in s.find_all("a", href=True):
+            if "sci-hub." in a["href"]:
+                urls.append(a["href"])
+        return urls
+
+    def set_proxy(self, proxy):
+        """
+        set proxy for session
+        :param proxy_dict:
+        :return:
+        """
+        if proxy:
+            self.sess.proxies = {
+                "http": proxy,
+                "https": proxy,
+            }
+
+    def _change_base_url(self):
+        # The next request goes to the best mirror, so only record the failure.
+        if self.base_url:
+            self.mirrors.report(self.base_url, False)
+            logger.info("I'm changing from {}".format(self.base_url))
+
+    def search(self, query, limit=10, download=False):
+        """
+        Performs a query on scholar.google.com, and returns a dictionary
+        of results in the form {'papers': ...}. Unfortunately, as of now,
+        captchas can potentially prevent searches after a certain limit.
+        """
+        start = 0
+        results = {"papers": []}
+
+        while True:
+            try:
+                res = self.sess.get(
+                    SCHOLARS_BASE_URL, params={"q": query, "start": start}
+                )
+            except requests.exceptions.RequestException as e:
+                results["err"] = (
+                    "Failed to complete search with query %s (connection error)" % query
+                )
+                return results
+
+            s = self._get_soup(res.content)
+            papers = s.find_all("div", class_="gs_r")
+
+            if not papers:
+                if "CAPTCHA" in str(res.content):
+                    results["err"] = (
+                        "Failed to complete search with query %s (captcha)" % query
+                    )
+                return results
+
+            for paper in papers:
+                if not paper.find("table"):
+                    source = None
+                    pdf = paper.find("div", class_="gs_ggs gs_fl")
+                    link = paper.find("h3", class_="gs_rt")
+
+                    if pdf:
+                        source = pdf.find("a")["href"]
+                    elif link.find("a"):
+                        source = link.find("a")["href"]
+                    else:
+                        continue
+
+                    results["papers"].append({"name": link.text, "url": source})
+
+                    if len(results["papers"]) >= limit:
+                        return results
+
+            start += 10
+
+    @retry(
+        wait_random_min=100,
+        wait_random_max=1000,
+        stop_max_attempt_number=10,
+        retry_on_exception=lambda e: not isinstance(
+            e, (NoMirrorAvailable, client.DownloadCancelled)
+        ),
+    )
+    def download(self, identifier, destination="", path=None, cancelled=None):
+        """
+        Downloads a paper from sci-hub given an indentifier (DOI, PMID, URL).
+        Currently, this can potentially be blocked by a captcha if a certain
+        limit has been reached.
+        """
+        data = self.fetch(
+            identifier, destination=destination or ".", path=path, cancelled=cancelled
+        )
+
+        if not "err" in data:
+            if not path:
+                os.replace(data["path"], os.path.join(destination, data["name"]))
+            return True
+        else:
+            return False
+
+    def fetch(self, identifier, destination=None, path=None, cancelled=None):
+        """
+        Fetches the paper by first retrieving the direct link to the pdf.
+        If the indentifier is a DOI, PMID, or URL pay-wall, then use Sci-Hub
+        to access and download paper. Otherwise, just download paper directly.
+
+        If destination is set, the pdf is streamed into destination/path
+        (data["path"]) instead of being kept in memory, a partial download
+        is resumed by the next call.
+        """
+
+        url = None
+        # The latency of the mirror, it is None if the mirror is not used.
+        self.latency = None
+        try:
+            url = self._get_direct_url(identifier)
+            logger.info("Resolved url %s for identifier %s" % (url, identifier))
+
+            # verify=False is dangerous but sci-hub.io
+            # requires intermediate certificates to verify
+            # and requests doesn't know how to download them.
+            # as a hacky fix, you can add them to your store
+            # and verifying would work. will fix this later.
+            if destination is None:
+                with get_host_limiter().slot(url):
+                    res = self.sess.get(url, verify=False)
+                if res.headers.get("Content-Type") == "application/pdf":
+                    if self.latency is not None:
+                        self.mirrors.report(self.base_url, True, self.latency)
+                    return {
+                        "pdf": res.content,
+                        "url": url,
+                        "name": self._generate_name(res),
+                    }
+            else:
+                responses = []
+
+                def is_pdf(res):
+                    responses.append(res)
+                    return res.headers.get("Content-Type") == "application/pdf"
+
+                filepath = os.path.join(
+                    destination,
+                    path or ".%s.pdf" % hashlib.md5(url.encode("utf-8")).hexdigest(),
+                )
+                with get_host_limiter().slot(url):
+                    info = client.download_file(
+                        url,
+                        filepath,
+                        self.sess,
+                        check_response=is_pdf,
+                        cancelled=cancelled,
+                        verify=False,
+                    )
+                if info is not None:
+                    if info["resumed"]:
+                        logger.info(
+                            "Resume %s from %s bytes." % (filepath, info["resumed"])
+                        )
+                    if self.latency is not None:
+                        self.mirrors.report(self.base_url, True, self.latency)
+                    return {
+                        "path": filepath,
+                        "url": url,
+                        "name": self._generate_name(responses[-1], info["md5"]),
+                        "md5": info["md5"],
+                        "sha256": info["sha256"],
+                    }
+
+            self._change_base_url()
+            logger.info(
+                "Failed to fetch pdf with identifier %s "
+                "(resolved url %s) due to captcha" % (identifier, url)
+            )
+            raise CaptchaNeedException(
+                "Failed to fetch pdf with identifier %s "
+                "(resolved url %s) due to captcha" % (identifier, url)
+            )
+            # return {
+            #     'err': 'Failed to fetch pdf with identifier %s (resolved url %s) due to captcha'
+            #            % (identifier, url)
+            # }
+
+        except requests.exceptions.ChunkedEncodingError:
+            # Let download retry it, the partial file is resumed.
+            logger.info("The download of %s is interrupted." % url)
+            raise
+
+        except requests.exceptions.ConnectionError:
+            logger.info("Cannot access {}, changing url".format(self.base_url))
+            self._change_base_url()
+
+        except requests.exceptions.RequestException as e:
+            if self.latency is not None:
+                # No url means the mirror works but doesn't have the paper.
+                self.mirrors.report(self.base_url, url is None, self.latency)
+            logger.info(
+                "Failed to fetch pdf with identifier %s (resolved url %s) due to request exception."
+                % (identifier, url)
+            )
+            return {
+                "err": "Failed to fetch pdf with identifier %s (resolved url %s) due to request exception."
+                % (identifier, url)
+            }
+
+    def _get_direct_url(self, identifier):
+        """
+        Finds the direct source url for a given identifier.
+        """
+        id_type = self._classify(identifier)
+
+        return (
+            identifier
+            if id_type == "url-direct"
+            else self._search_direct_url(identifier)
+        )
+
+    def _search_direct_url(self, identifier):
+        """
+        Sci-Hub embeds papers in an iframe. This function finds the actual
+        source url which looks something like https://moscow.sci-hub.io/.../....pdf.
+        """
+        self.base_url = self.mirrors.choose() + "/"
+        started_at = time.monotonic()
+        with get_host_limiter().slot(self.base_url):
+            res = client.get(
+                self.base_url + identifier, session=self.sess, verify=False
+            )
+        logger.info("Getting direct url %s" % self.base_url + identifier)
+        if res.status_code >= 500 or b"captcha" in res.content.lower():
+            url = self.base_url + identifier
+            self._change_base_url()
+            raise CaptchaNeedException(
+                "Failed to get the direct url from %s (status code %s)"
+                % (url, res.status_code)
+            )
+
+        self.latency = time.monotonic() - started_at
+        s = self._get_soup(res.content)
+        iframe = s.find("iframe")
+        if iframe:
+            return (
+                iframe.get("src")
+                if not iframe.get("src").startswith("//")
+                else "http:" + iframe.get("src")
+            )
+
+    def _classify(self, identifier):
+        """
+        Classify the type of identifier:
+        url-direct - openly accessible paper
+        url-non-direct - pay-walled paper
+        pmid - PubMed ID
+        doi - digital object identifier
+        """
+        if identifier.startswith("http") or identifier.startswith("https"):
+            if identifier.endswith("pdf"):
+                return "url-direct"
+            else:
+                return "url-non-direct"
+        elif identifier.isdigit():
+            return "pmid"
+        else:
+            return "doi"
+
+    def _save(self, data, path):
+        """
+        Save a file give data and a path.
+        """
+        with open(path, "wb") as f:
+            f.write(data)
+
+    def _get_soup(self, html):
+        """
+        Return html soup.
+        """
+        return BeautifulSoup(html, "html.parser")
+
+    def _generate_name(self, res, pdf_hash=None):
+        """
+        Generate unique filename for paper. Returns a name by calcuating
+        md5 hash of file contents, then appending the last 20 characters
+        of the url which typically provides a good paper identifier.
+        """
+        name = res.url.split("/")[-1]
+        name = re.sub("#view=(.+)", "", name)
+        if pdf_hash is None:
+            pdf_hash = hashlib.md5(res.content).hexdigest()
+        return "%s-%s" % (pdf_hash, name[-20:])
+
+
+def find_pmc_pdf_links(content):
+    soup = BeautifulSoup(content, "html.parser")
+    pdf_links = soup.find_all("a", attrs={"class": "int-view"})
+    return [pdf_link.get("href") for pdf_link in pdf_links if pdf_link.get("href")]
+
+
+def get_pmc_page(url, cache=None):
+    """Get the content of a PMC article page, from the cache if possible.
+
+    Only the pages with a pdf link are cached, a captcha or bot challenge page
+    is not.
+
+    Returns:
+        tuple: (status_code, content)
+    """
+    content = cache.get("pmc", url) if cache else None
+    if content is not None:
+        return 200, content
+
+    with get_host_limiter().slot(url):
+        html = client.get(url, headers=headers)
+    if html.status_code == 200 and cache and find_pmc_pdf_links(html.content):
+        cache.set("pmc", url, None, html.content)
+    return html.status_code, html.content
+
+
+def download_pmc(pmcid, filepath, cache=None, cancelled=None):
+    url = PMC_BASE_URL + "/pmc/articles/" + str(pmcid) + "/"
+    status_code, content = get_pmc_page(url, cache)
+    if status_code == 200:
+        pdf_links = find_pmc_pdf_links(content)
+        logger.info("Find pdf links: %s" % pdf_links)
+        if pdf_links:
+            pdf_link = list(set(pdf_links))[0]
+            pdf_link = PMC_BASE_URL + pdf_link
+            status_codes = []
+
+            def is_ok(res):
+                status_codes.append(res.status_code)
+                return res.status_code in [200, 206]
+
+            with get_host_limiter().slot(pdf_link):
+                info = client.download_file(
+                    pdf_link,
+                    filepath,
+                    check_response=is_ok,
+                    cancelled=cancelled,
+                    headers=headers,
+                )
+            if info is not None:
+                logger.info("Download %s succssfully." % filepath)
+                return True
+            else:
+                logger.warning(
+                    "Download %s failed, status code is %s." % (url, status_codes[-1])
+                )
+                return False
+    else:
+        logger.warning("Download %s failed, status code is %s." % (url, status_code))
+        return False
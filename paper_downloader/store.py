@@ -0,0 +1,166 @@
+import os
+import time
+import shutil
+import sqlite3
+import hashlib
+import logging
+import tempfile
+import threading
+
+logger = logging.getLogger("paper-downloader")
+
+CHUNK_SIZE = 64 * 1024
+
+
+def file_sha256(filename, chunk_size=CHUNK_SIZE):
+    sha256 = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def link_file(src, dest):
+    """Hardlink src to dest, copy it if they are on different filesystems.
+
+    The dest is replaced atomically.
+    """
+    dirname = os.path.dirname(os.path.abspath(dest))
+    fd, tmp_file = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=dirname)
+    os.close(fd)
+    os.remove(tmp_file)
+    try:
+        os.link(src, tmp_file)
+    except OSError:
+        shutil.copyfile(src, tmp_file)
+
+    try:
+        os.replace(tmp_file, dest)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+
+
+class PdfStore(object):
+    """A content-addressed store of pdfs shared by several projects.
+
+    Every pdf is saved once as objects/<sha256[:2]>/<sha256>.pdf, next to the
+    html converted from it. An sqlite table maps the pmids and dois to the
+    pdfs, so a paper which was downloaded for one project is linked into the
+    other projects instead of being downloaded and converted again.
+
+    Steps:
+        store = PdfStore("/data/publications/.store")
+        if not store.checkout(dest_file, pmid=pmid, doi=doi):
+            ... download dest_file ...
+            store.add(dest_file, pmid=pmid, doi=doi)
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = os.path.abspath(os.path.expanduser(store_dir))
+        self.objects_dir = os.path.join(self.store_dir, "objects")
+        self.lock = threading.Lock()
+
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self.conn = sqlite3.connect(
+            os.path.join(self.store_dir, "index.sqlite"),
+            timeout=30,
+            check_same_thread=False,
+        )
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS pdfs (
+                sha256 TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS ids (
+                kind TEXT NOT NULL,
+                id TEXT NOT NULL,
+                sha256 TEXT NOT NULL,
+                PRIMARY KEY (kind, id)
+            ) WITHOUT ROWID;
+            """
+        )
+
+    def pdf_path(self, sha256):
+        return os.path.join(self.objects_dir, sha256[:2], sha256 + ".pdf")
+
+    def html_path(self, sha256):
+        return os.path.join(self.objects_dir, sha256[:2], sha256 + ".html")
+
+    @staticmethod
+    def _ids(pmid=None, doi=None):
+        ids = []
+        if pmid:
+            ids.append(("pmid", str(pmid)))
+        if doi:
+            ids.append(("doi", str(doi).lower()))
+        return ids
+
+    def lookup(self, pmid=None, doi=None):
+        """Get the sha256 of the pdf of a paper, None if it is not in the store."""
+        with self.lock:
+            for kind, id in self._ids(pmid, doi):
+                row = self.conn.execute(
+                    "SELECT sha256 FROM ids WHERE kind = ? AND id = ?", (kind, id)
+                ).fetchone()
+                if row and os.path.exists(self.pdf_path(row[0])):
+                    return row[0]
+        return None
+
+    def checkout(self, dest, pmid=None, doi=None):
+        """Link the pdf of a paper to dest, return False if it is not in the store."""
+        sha256 = self.lookup(pmid, doi)
+        if sha256 is None:
+            return False
+
+        link_file(self.pdf_path(sha256), dest)
+        logger.info("Link %s from the pdf store (%s)." % (dest, sha256))
+        return True
+
+    def add(self, pdf_file, pmid=None, doi=None, sha256=None):
+        """Save a pdf into the store and index it by the pmid and the doi.
+
+        Returns:
+            str: the sha256 of the pdf.
+        """
+        sha256 = sha256 or file_sha256(pdf_file)
+        blob = self.pdf_path(sha256)
+        if not os.path.exists(blob):
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            link_file(pdf_file, blob)
+
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO pdfs (sha256, size, created_at) VALUES (?, ?, ?)",
+                (sha256, os.path.getsize(blob), time.time()),
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO ids (kind, id, sha256) VALUES (?, ?, ?)",
+                [(kind, id, sha256) for kind, id in self._ids(pmid, doi)],
+            )
+        return sha256
+
+    def checkout_html(self, pdf_file, html_file):
+        """Link the html converted from the same pdf to html_file, if there is one."""
+        html = self.html_path(file_sha256(pdf_file))
+        if not os.path.exists(html):
+            return False
+
+        link_file(html, html_file)
+        logger.info("Link %s from the pdf store." % html_file)
+        return True
+
+    def add_html(self, pdf_file, html_file):
+        """Save the html converted from a pdf into the store."""
+        sha256 = file_sha256(pdf_file)
+        html = self.html_path(sha256)
+        if os.path.exists(html) or not os.path.exists(html_file):
+            return
+
+        os.makedirs(os.path.dirname(html), exist_ok=True)
+        link_file(html_file, html)
+
+    def close(self):
+        self.conn.close()
@@ -1,6 +1,5 @@
 import os
 import hashlib
-import requests
 import click
 import tempfile
 import logging
@@ -8,6 +7,7 @@ import subprocess
 import json
 import threading, time, signal
 from datetime import timedelta
+from paper_downloader import client
 
 logger = logging.getLogger("paper_downloader.syncer")
 formatter = logging.Formatter("%(asctime)s %(levelname)s %(message)s")
@@ -294,7 +294,7 @@ def get_organizations(ls_server, token):
     """
     url = f"{ls_server}/api/organizations"
     try:
-        response = requests.get(url, headers={"Authorization": f"Token {token}"})
+        response = client.get(url, headers={"Authorization": f"Token {token}"})
         response.raise_for_status()
         organizations = response.json()
         return organizations
@@ -344,7 +344,7 @@ def get_users_by_organization(ls_server, token, organization_id):
     """
     url = f"{ls_server}/api/organizations/{organization_id}/memberships"
     try:
-        response = requests.get(url, headers={"Authorization": f"Token {token}"})
+        response = client.get(url, headers={"Authorization": f"Token {token}"})
         response.raise_for_status()
         results = response.json().get("results", [])
         return [result["user"] for result in results]
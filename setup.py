@@ -42,6 +42,10 @@ setup(
         ],
     },
     install_requires=requirements + ["metapub @ git+https://github.com/yjcyxky/metapub.git@master"],
+    extras_require={
+        # Only the export-parquet command needs it.
+        "parquet": ["pyarrow>=6.0.1"],
+    },
     license="MIT license",
     long_description=readme + "\n\n" + history,
     include_package_data=True,
@@ -0,0 +1,136 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+import unittest
+import http.server
+import socketserver
+
+from paper_downloader import client
+
+DATA = bytes(range(256)) * 64
+ETAG = '"v2"'
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, status, body, content_range=None):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/pdf")
+        self.send_header("ETag", ETAG)
+        self.send_header("Content-Length", str(len(body)))
+        if content_range:
+            self.send_header("Content-Range", content_range)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        range_header = self.headers.get("Range", "")
+        start = int(range_header[len("bytes=") : -1]) if range_header else None
+        if_range = self.headers.get("If-Range")
+
+        if self.path == "/file.pdf" and start is not None and if_range == ETAG:
+            self.send_body(
+                206,
+                DATA[start:],
+                "bytes %s-%s/%s" % (start, len(DATA) - 1, len(DATA)),
+            )
+        elif self.path == "/shifted.pdf" and start is not None:
+            # A broken server which always sends the range from 1024.
+            self.send_body(
+                206, DATA[1024:], "bytes 1024-%s/%s" % (len(DATA) - 1, len(DATA))
+            )
+        else:
+            self.send_body(200, DATA)
+
+
+class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class DownloadFileTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = Server(("127.0.0.1", 0), Handler)
+        cls.base_url = "http://127.0.0.1:%s" % cls.server.server_address[1]
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.requests = []
+        self.output_dir = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.output_dir, "1.pdf")
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def write_part(self, url, size, etag=ETAG):
+        with open(self.filepath + ".part", "wb") as f:
+            f.write(DATA[:size])
+        with open(self.filepath + ".part.json", "w") as f:
+            json.dump({"url": url, "etag": etag, "last_modified": None}, f)
+
+    def assert_downloaded(self, info, resumed):
+        with open(self.filepath, "rb") as f:
+            self.assertEqual(f.read(), DATA)
+        self.assertEqual(info["size"], len(DATA))
+        self.assertEqual(info["sha256"], hashlib.sha256(DATA).hexdigest())
+        self.assertEqual(info["resumed"], resumed)
+        self.assertEqual(os.listdir(self.output_dir), ["1.pdf"])
+
+    def test_matching_206_appends(self):
+        url = self.base_url + "/file.pdf"
+        self.write_part(url, 4096)
+
+        info = client.download_file(url, self.filepath)
+
+        self.assert_downloaded(info, 4096)
+        self.assertEqual(len(self.server.requests), 1)
+        headers = self.server.requests[0][1]
+        self.assertEqual(headers["Range"], "bytes=4096-")
+        self.assertEqual(headers["If-Range"], ETAG)
+
+    def test_200_restarts(self):
+        url = self.base_url + "/norange.pdf"
+        self.write_part(url, 4096)
+
+        info = client.download_file(url, self.filepath)
+
+        self.assert_downloaded(info, 0)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_mismatched_206_restarts_without_range(self):
+        url = self.base_url + "/shifted.pdf"
+        self.write_part(url, 4096)
+
+        info = client.download_file(url, self.filepath)
+
+        self.assert_downloaded(info, 0)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.server.requests[0][1]["Range"], "bytes=4096-")
+        self.assertNotIn("Range", self.server.requests[1][1])
+
+    def test_changed_etag_gets_a_200(self):
+        url = self.base_url + "/file.pdf"
+        self.write_part(url, 4096, etag='"v1"')
+
+        info = client.download_file(url, self.filepath)
+
+        self.assert_downloaded(info, 0)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(self.server.requests[0][1]["If-Range"], '"v1"')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from paper_downloader.jobs import JobQueue
+
+
+class JobQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.queue = JobQueue(
+            os.path.join(self.tmp_dir, "jobs.sqlite"),
+            lease_seconds=0.1,
+            retry_base_seconds=0,
+        )
+
+    def tearDown(self):
+        self.queue.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def expire(self):
+        time.sleep(0.2)
+
+    def test_expired_job_without_attempts_left_fails(self):
+        job_id = self.queue.enqueue("convert", {"pdf_file": "1.pdf"}, max_attempts=2)
+        failed = []
+
+        # The worker dies every time, so it never reaches fail().
+        self.assertEqual(self.queue.lease("worker-1")["attempts"], 1)
+        self.expire()
+        job = self.queue.lease("worker-2", on_failed=lambda *args: failed.append(args))
+        self.assertEqual((job["id"], job["attempts"]), (job_id, 2))
+        self.assertEqual(failed, [])
+
+        self.expire()
+        self.assertIsNone(
+            self.queue.lease("worker-3", on_failed=lambda *args: failed.append(args))
+        )
+        self.assertEqual(len(failed), 1)
+        job, error = failed[0]
+        self.assertEqual(
+            (job["id"], job["status"], job["attempts"]), (job_id, "failed", 2)
+        )
+        self.assertIn("lease expired", str(error))
+        self.assertEqual(self.queue.counts(), {"failed": 1})
+
+        self.expire()
+        self.assertIsNone(self.queue.lease("worker-4"))
+
+    def test_worker_which_lost_the_lease_cannot_change_the_job(self):
+        job_id = self.queue.enqueue("download", {"metadata_file": "1.json"})
+        self.queue.lease("worker-1")
+        self.expire()
+        self.assertEqual(self.queue.lease("worker-2")["id"], job_id)
+
+        # worker-1 finishes late, the job belongs to worker-2 now.
+        self.assertFalse(self.queue.complete(job_id, "worker-1"))
+        self.assertIsNone(self.queue.fail(job_id, "worker-1", "late"))
+        self.assertFalse(self.queue.renew(job_id, "worker-1"))
+        self.assertEqual(self.queue.counts(), {"running": 1})
+
+        self.assertTrue(self.queue.complete(job_id, "worker-2"))
+        self.assertEqual(self.queue.counts(), {"done": 1})
+        self.assertFalse(self.queue.complete(job_id, "worker-2"))
+
+    def test_failed_job_is_retried_until_no_attempts_left(self):
+        job_id = self.queue.enqueue(
+            "download", {"metadata_file": "1.json"}, max_attempts=2
+        )
+
+        self.queue.lease("worker-1")
+        self.assertTrue(self.queue.fail(job_id, "worker-1", "timeout"))
+        self.assertEqual(self.queue.counts(), {"pending": 1})
+
+        self.queue.lease("worker-1")
+        self.assertFalse(self.queue.fail(job_id, "worker-1", "timeout"))
+        self.assertEqual(self.queue.counts(), {"failed": 1})
+        self.assertIsNone(self.queue.lease("worker-1"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,169 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+import http.server
+import socketserver
+
+from paper_downloader import client
+from paper_downloader.pdfcheck import check_pdf
+from paper_downloader.ratelimit import set_host_limiter
+from paper_downloader.resolvers import PdfResolver, Source, download_pdf_url
+
+PDF = b"%PDF-1.4\n" + b"0" * 4096 + b"\n%%EOF\n"
+HTML = b"<html><body>Please complete the captcha.</body></html>" * 50
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def send_pdf_headers(self, length=None):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/pdf")
+        self.send_header("ETag", '"pdf"')
+        if length is None:
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            self.send_header("Content-Length", str(length))
+        self.end_headers()
+
+    def do_GET(self):
+        try:
+            if self.path == "/valid.pdf":
+                self.send_pdf_headers(len(PDF))
+                self.wfile.write(PDF)
+            elif self.path == "/slow.pdf":
+                # About 10 seconds, it is cancelled when another source wins.
+                chunk = b"0" * 16 * 1024
+                self.send_pdf_headers(len(chunk) * 100)
+                for i in range(100):
+                    self.wfile.write(chunk)
+                    self.wfile.flush()
+                    time.sleep(0.1)
+            elif self.path == "/broken.pdf":
+                # The connection is closed in the middle of the body.
+                self.send_pdf_headers()
+                self.wfile.write(b"%x\r\n%s\r\n" % (1024, PDF[:1024]))
+                self.wfile.flush()
+                self.close_connection = True
+            elif self.path == "/invalid.pdf":
+                self.send_pdf_headers(len(HTML))
+                self.wfile.write(HTML)
+            else:
+                self.send_response(500)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class UrlSource(Source):
+    """A source which downloads the pdf from a url of the test server."""
+
+    def __init__(self, name, url):
+        self.name = name
+        self.url = url
+        self.finished = threading.Event()
+        self.error = None
+
+    def fetch(self, article, filepath, cancelled=None):
+        try:
+            return download_pdf_url(self.url, filepath, cancelled)
+        except Exception as e:
+            self.error = e
+            raise
+        finally:
+            self.finished.set()
+
+
+class PdfResolverTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = Server(("127.0.0.1", 0), Handler)
+        cls.base_url = "http://127.0.0.1:%s" % cls.server.server_address[1]
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        # All the stand-in sources are on the same host.
+        set_host_limiter(default=10)
+        self.output_dir = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.output_dir, "1.pdf")
+
+    def tearDown(self):
+        set_host_limiter()
+        shutil.rmtree(self.output_dir)
+
+    def source(self, name, path):
+        return UrlSource(name, self.base_url + path)
+
+    def resolver(self, sources, hedge_delay=0.2):
+        return PdfResolver(sources, hedge_delay=hedge_delay, stats_file=False)
+
+    def test_fast_valid_source_wins(self):
+        broken = self.source("broken", "/broken.pdf")
+        failing = self.source("failing", "/failing.pdf")
+        slow = self.source("slow", "/slow.pdf")
+        valid = self.source("valid", "/valid.pdf")
+        resolver = self.resolver([broken, failing, slow, valid])
+
+        started_at = time.monotonic()
+        winner = resolver.resolve({"pmid": "1"}, self.filepath)
+
+        self.assertEqual(winner, "valid")
+        self.assertLess(time.monotonic() - started_at, 5)
+        with open(self.filepath, "rb") as f:
+            self.assertEqual(f.read(), PDF)
+
+        # The slow source is cancelled instead of finishing its download.
+        self.assertTrue(slow.finished.wait(5))
+        self.assertIsInstance(slow.error, client.DownloadCancelled)
+
+        # The partial downloads of the other sources are removed.
+        time.sleep(0.2)
+        self.assertEqual(os.listdir(self.output_dir), ["1.pdf"])
+
+    def test_invalid_pdf_is_rejected(self):
+        invalid = self.source("invalid", "/invalid.pdf")
+        resolver = self.resolver([invalid])
+
+        self.assertIsNone(resolver.resolve({"pmid": "1"}, self.filepath))
+        self.assertFalse(os.path.exists(self.filepath))
+
+        tmp_file = os.path.join(self.output_dir, "invalid.pdf")
+        download_pdf_url(invalid.url, tmp_file)
+        valid, reason = check_pdf(tmp_file)
+        self.assertFalse(valid)
+        self.assertIn("%PDF-", reason)
+
+    def test_next_source_after_invalid_pdf(self):
+        invalid = self.source("invalid", "/invalid.pdf")
+        valid = self.source("valid", "/valid.pdf")
+        resolver = self.resolver([invalid, valid], hedge_delay=10)
+
+        self.assertEqual(resolver.resolve({"pmid": "1"}, self.filepath), "valid")
+        self.assertEqual(check_pdf(self.filepath), (True, None))
+
+    def test_no_source_has_the_pdf(self):
+        failing = self.source("failing", "/failing.pdf")
+        resolver = self.resolver([failing])
+
+        self.assertIsNone(resolver.resolve({"pmid": "1"}, self.filepath))
+        self.assertEqual(os.listdir(self.output_dir), [])
+
+
+if __name__ == "__main__":
+    unittest.main()